@@ -0,0 +1,121 @@
+# coding=utf-8
+"""Microbenchmark of `BERTLayerNorm`, `gelu` and `BERTLayer` against the composed ops they replaced.
+
+Times each op, forward and backward, at the shape of one C3 micro-batch and
+checks that the fused kernels match the element-wise reference:
+
+    python benchmarks/bench_layers.py --batch_size 16 --seq_length 512
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import math
+import os
+import sys
+import time
+
+import torch
+import torch.nn as nn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modeling
+from modeling import BertConfig, BERTLayer, BERTLayerNorm
+
+
+class ReferenceLayerNorm(nn.Module):
+    """The `BERTLayerNorm` made of six element-wise ops, sharing the parameters of `layer_norm`."""
+
+    def __init__(self, layer_norm):
+        super(ReferenceLayerNorm, self).__init__()
+        self.gamma = layer_norm.gamma
+        self.beta = layer_norm.beta
+        self.variance_epsilon = layer_norm.variance_epsilon
+
+    def forward(self, x):
+        u = x.mean(-1, keepdim=True)
+        s = (x - u).pow(2).mean(-1, keepdim=True)
+        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
+        return self.gamma * x + self.beta
+
+
+def reference_gelu(x):
+    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+
+
+def reference_layer(layer):
+    """A copy of `layer` running the reference LayerNorm and gelu."""
+    layer = copy.deepcopy(layer)
+    for module in (layer.attention.output, layer.output):
+        module.LayerNorm = ReferenceLayerNorm(module.LayerNorm)
+    layer.intermediate.intermediate_act_fn = reference_gelu
+    return layer
+
+
+def time_op(fn, inputs, steps, backward):
+    def run():
+        output = fn(*inputs)
+        if backward:
+            output.sum().backward()
+        return output
+
+    run()
+    start = time.time()
+    for _ in range(steps):
+        run()
+    return (time.time() - start) / steps, run()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_config_file", default=None, type=str,
+                        help="BERT config to benchmark. Defaults to BERT-base with the Chinese vocab size.")
+    parser.add_argument("--batch_size", default=16, type=int,
+                        help="Number of sequences, i.e. questions times choices.")
+    parser.add_argument("--seq_length", default=512, type=int)
+    parser.add_argument("--steps", default=10, type=int)
+    parser.add_argument("--backward", default=False, action='store_true',
+                        help="Whether to time the backward pass too.")
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.bert_config_file:
+        config = BertConfig.from_json_file(args.bert_config_file)
+    else:
+        config = BertConfig(vocab_size=21128)
+    torch.manual_seed(0)
+    layer_norm = BERTLayerNorm(config).to(device)
+    # Random parameters, as the initial ones make LayerNorm an identity after normalizing.
+    layer_norm.gamma.data.normal_()
+    layer_norm.beta.data.normal_()
+    layer = BERTLayer(config).to(device).train(False)
+
+    shape = (args.batch_size, args.seq_length)
+    hidden = torch.randn(shape + (config.hidden_size,), device=device, requires_grad=args.backward)
+    intermediate = torch.randn(shape + (config.intermediate_size,), device=device, requires_grad=args.backward)
+    attention_mask = torch.zeros(args.batch_size, 1, 1, args.seq_length, device=device)
+
+    ops = [
+        ("LayerNorm", ReferenceLayerNorm(layer_norm), layer_norm, (hidden,)),
+        ("gelu", reference_gelu, modeling.gelu, (intermediate,)),
+        ("BERTLayer", reference_layer(layer), layer, (hidden, attention_mask)),
+    ]
+    print("device %s, %d x %d tokens, %s" % (device, args.batch_size, args.seq_length,
+                                             "forward+backward" if args.backward else "forward"))
+    print("%-10s %14s %14s %8s %12s" % ("op", "reference ms", "fused ms", "speedup", "max |diff|"))
+    with torch.set_grad_enabled(args.backward):
+        for name, reference, fused, inputs in ops:
+            reference_time, expected = time_op(reference, inputs, args.steps, args.backward)
+            fused_time, actual = time_op(fused, inputs, args.steps, args.backward)
+            print("%-10s %14.2f %14.2f %7.2fx %12.3g" % (
+                name, reference_time * 1000, fused_time * 1000, reference_time / fused_time,
+                (expected - actual).abs().max().item()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+# coding=utf-8
+"""Speed, peak memory and output parity of `modeling.BertModel` variants.
+
+Runs a forward pass (and optionally a backward pass) of every variant over
+the same padded batch, each in a fresh process so that peak memory is
+measured on its own, and compares the outputs against the first variant:
+
+    python benchmarks/bench_modeling.py --bert_config_file ../chinese_L-12_H-768_A-12/bert_config.json \
+        --batch_size 16 --seq_length 512
+
+The checkpoint_* variants only differ from eager when training, so compare
+them with --backward. On CPU, peak memory is the growth of the process's maximum resident set size
+over the forward (and backward) pass; on CUDA it is the peak allocated memory.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import queue as queue_module
+import resource
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import modeling
+from modeling import BertConfig, BertModel
+
+# name: (BertConfig overrides, BertModel.forward keyword arguments,
+#        BERTEncoder.set_checkpointing keyword arguments given the command line arguments)
+VARIANTS = {
+    "eager": (dict(attention_backend="eager"), {}, None),
+    "sdpa": (dict(attention_backend="sdpa"), {}, None),
+    "last_layer": ({}, dict(output_layers="last"), None),
+    "pooled_only": ({}, dict(output_layers="pooled"), None),
+    "checkpoint_all": ({}, {}, lambda args: dict(every=1)),
+    "checkpoint_every_2": ({}, {}, lambda args: dict(every=2)),
+    "checkpoint_budget": ({}, {}, lambda args: dict(memory_mb=args.checkpoint_memory_mb)),
+}
+
+
+def build_inputs(args, config):
+    generator = torch.Generator().manual_seed(args.seed)
+    input_ids = torch.randint(1, config.vocab_size, (args.batch_size, args.seq_length), generator=generator)
+    # Every other sequence is padded to a random length, so the mask matters.
+    lengths = torch.randint(args.seq_length // 4, args.seq_length + 1, (args.batch_size,), generator=generator)
+    lengths[::2] = args.seq_length
+    input_mask = (torch.arange(args.seq_length).unsqueeze(0) < lengths.unsqueeze(1)).long()
+    segment_ids = (torch.arange(args.seq_length).unsqueeze(0) >= lengths.unsqueeze(1) // 2).long() * input_mask
+    return input_ids, segment_ids, input_mask
+
+
+def peak_memory_mb(device):
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def run_variant(args, name, queue):
+    torch.set_num_threads(args.num_threads or torch.get_num_threads())
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.bert_config_file:
+        config = BertConfig.from_json_file(args.bert_config_file)
+    else:
+        config = BertConfig(vocab_size=21128)
+    if args.num_hidden_layers:
+        config.num_hidden_layers = args.num_hidden_layers
+    config_overrides, forward_kwargs, checkpointing = VARIANTS[name]
+    for key, value in config_overrides.items():
+        setattr(config, key, value)
+
+    torch.manual_seed(args.seed)
+    model = BertModel(config).to(device=device, dtype=modeling.parameter_dtype(args.precision))
+    if checkpointing is not None:
+        model.encoder.set_checkpointing(**checkpointing(args))
+    inputs = [t.to(device) for t in build_inputs(args, config)]
+    model.train(args.backward)
+
+    def step():
+        with torch.set_grad_enabled(args.backward), modeling.autocast(device, args.precision):
+            encoder_layers, pooled_output = model(*inputs, **forward_kwargs)
+        sequence_output = encoder_layers[-1] if encoder_layers else None
+        if args.backward:
+            loss = pooled_output.float().sum()
+            if sequence_output is not None:
+                loss = loss + sequence_output.float().sum()
+            loss.backward()
+            model.zero_grad(set_to_none=True)
+        return sequence_output, pooled_output
+
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    base_memory = peak_memory_mb(device) if device.type == "cpu" else 0.0
+    # Dropout is left on when timing backward passes, so outputs are only compared without.
+    sequence_output, pooled_output = step()
+    memory = peak_memory_mb(device) - base_memory
+
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(args.steps):
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    seconds = (time.time() - start) / max(args.steps, 1)
+    # numpy arrays are pickled whole, whereas tensors would be shared with the exiting process.
+    if sequence_output is not None:
+        sequence_output = sequence_output.detach().float().cpu().numpy()
+    queue.put((seconds, memory, sequence_output, pooled_output.detach().float().cpu().numpy()))
+
+
+def receive(queue, process, name):
+    """Waits for the results of `process`, failing if it dies first (e.g. out of memory)."""
+    while True:
+        try:
+            return queue.get(timeout=1)
+        except queue_module.Empty:
+            if not process.is_alive():
+                raise RuntimeError("Variant %s exited with code %s" % (name, process.exitcode))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_config_file", default=None, type=str,
+                        help="BERT config to benchmark. Defaults to BERT-base with the Chinese vocab size.")
+    parser.add_argument("--num_hidden_layers", default=None, type=int,
+                        help="Overrides the number of layers of the config, to benchmark faster.")
+    parser.add_argument("--variants", default="eager,sdpa", type=str,
+                        help="Comma-separated variants out of %s; the first one is the reference." % (
+                            ", ".join(sorted(VARIANTS))))
+    parser.add_argument("--batch_size", default=8, type=int,
+                        help="Number of sequences, i.e. questions times choices.")
+    parser.add_argument("--seq_length", default=512, type=int)
+    parser.add_argument("--precision", default="fp32", choices=modeling.PRECISIONS)
+    parser.add_argument("--backward", default=False, action='store_true',
+                        help="Whether to time training steps (forward and backward) instead of inference.")
+    parser.add_argument("--checkpoint_memory_mb", default=1024, type=float,
+                        help="Activation budget of the checkpoint_budget variant.")
+    parser.add_argument("--steps", default=3, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    reference = None
+    print("%d x %d tokens, %s, %s" % (args.batch_size, args.seq_length, args.precision,
+                                      "forward+backward" if args.backward else "forward"))
+    print("%-20s %12s %14s %14s %14s" % ("variant", "ms/step", "peak MB", "max |dseq|", "max |dpooled|"))
+    for name in args.variants.split(","):
+        if name not in VARIANTS:
+            raise ValueError("Unknown variant %s - should be one of %s" % (name, ", ".join(sorted(VARIANTS))))
+        queue = context.Queue()
+        process = context.Process(target=run_variant, args=(args, name, queue))
+        process.start()
+        seconds, memory, sequence_output, pooled_output = receive(queue, process, name)
+        process.join()
+        if reference is None:
+            reference = (sequence_output, pooled_output)
+        diffs = ["%14s" % "-", "%14s" % "-"]
+        if not args.backward:
+            if sequence_output is not None and reference[0] is not None:
+                diffs[0] = "%14.3g" % np.abs(sequence_output - reference[0]).max()
+            diffs[1] = "%14.3g" % np.abs(pooled_output - reference[1]).max()
+        print("%-20s %12.1f %14.1f %s %s" % (name, seconds * 1000, memory, diffs[0], diffs[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+# coding=utf-8
+"""Microbenchmark of `BERTAdam.step` on the parameters of a BERT classifier.
+
+Compares the per-tensor loop against the multi-tensor (foreach) update, with
+per-tensor and global gradient clipping, and times the learning rate query:
+
+    python benchmarks/bench_optimization.py --bert_config_file ../chinese_L-12_H-768_A-12/bert_config.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modeling import BertConfig, BertForSequenceClassification
+from optimization import BERTAdam
+
+
+def build_optimizer(model, **kwargs):
+    no_decay = ['bias', 'gamma', 'beta']
+    optimizer_parameters = [
+        {'params': [p for n, p in model.named_parameters() if n not in no_decay], 'weight_decay_rate': 0.01},
+        {'params': [p for n, p in model.named_parameters() if n in no_decay], 'weight_decay_rate': 0.0}
+        ]
+    return BERTAdam(optimizer_parameters, lr=1e-5, warmup=0.1, t_total=10000, **kwargs)
+
+
+def time_steps(model, optimizer, steps, warmup_steps, device):
+    for p in model.parameters():
+        p.grad = torch.randn_like(p)
+    for _ in range(warmup_steps):
+        optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(steps):
+        optimizer.step()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.time() - start) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_config_file", default=None, type=str,
+                        help="BERT config to benchmark. Defaults to BERT-base with the Chinese vocab size.")
+    parser.add_argument("--steps", default=20, type=int)
+    parser.add_argument("--warmup_steps", default=3, type=int)
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.bert_config_file:
+        config = BertConfig.from_json_file(args.bert_config_file)
+    else:
+        config = BertConfig(vocab_size=21128)
+    model = BertForSequenceClassification(config, 1).to(device)
+    num_params = sum(p.numel() for p in model.parameters())
+    print("device %s, %d tensors, %d parameters" % (device, len(list(model.parameters())), num_params))
+
+    variants = [
+        ("loop, per-tensor clip", dict(foreach=False, per_tensor_clip=True)),
+        ("loop, global clip", dict(foreach=False)),
+        ("foreach, global clip", dict(foreach=True)),
+    ]
+    for name, kwargs in variants:
+        optimizer = build_optimizer(model, **kwargs)
+        seconds = time_steps(model, optimizer, args.steps, args.warmup_steps, device)
+        print("%-24s %8.2f ms/step" % (name, seconds * 1000))
+
+    start = time.time()
+    for _ in range(1000):
+        optimizer.get_lr()
+    print("%-24s %8.2f us/call" % ("get_lr", (time.time() - start) * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+# coding=utf-8
+"""Padding waste, parity and speed of packed-sequence training batches.
+
+Batches a C3 split as `run_classifier.py` does, and compares the padded
+batches of `feature_store.trim_collate` with the packed rows of
+`feature_store.pack_collate`: tokens computed, logits of the same weights in
+eval mode, and the time of training steps:
+
+    python benchmarks/bench_packing.py --data_dir ../data \
+        --bert_config_file ../chinese_L-12_H-768_A-12/bert_config.json \
+        --vocab_file ../chinese_L-12_H-768_A-12/vocab.txt \
+        --init_checkpoint ../chinese_L-12_H-768_A-12/pytorch_model.bin
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import functools
+import os
+import sys
+import time
+
+import torch
+from torch.utils.data import DataLoader, SequentialSampler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feature_store
+import run_classifier
+import tokenization
+from modeling import BertConfig, BertForSequenceClassification
+from optimization import BERTAdam
+
+
+def batch_inputs(batch, packed, device):
+    batch = tuple(t.to(device).long() for t in batch)
+    if packed:
+        input_ids, sequence_ids, segment_ids, position_ids, cls_index, label_ids = batch
+        return (input_ids, segment_ids, sequence_ids, label_ids, run_classifier.n_class), \
+            dict(position_ids=position_ids, cls_index=cls_index)
+    input_ids, input_mask, segment_ids, label_ids = batch
+    return (input_ids, segment_ids, input_mask, label_ids, run_classifier.n_class), {}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="../data", type=str)
+    parser.add_argument("--split", default="dev", type=str,
+                        help="C3 split to batch, e.g. dev, train or bucket0.")
+    parser.add_argument("--bert_config_file", default=None, type=str, required=True)
+    parser.add_argument("--vocab_file", default=None, type=str, required=True)
+    parser.add_argument("--init_checkpoint", default=None, type=str)
+    parser.add_argument("--max_seq_length", default=512, type=int)
+    parser.add_argument("--pack_length", default=None, type=int,
+                        help="Length of the packed rows. Defaults to max_seq_length.")
+    parser.add_argument("--batch_size", default=4, type=int,
+                        help="Questions per batch, i.e. the micro-batch of run_classifier.py.")
+    parser.add_argument("--max_batches", default=20, type=int,
+                        help="Number of batches whose logits are compared and whose training steps are timed.")
+    parser.add_argument("--do_lower_case", default=False, action='store_true',
+                        help="As given to run_classifier.py when training.")
+    parser.add_argument("--cache_dir", default=None, type=str)
+    parser.add_argument("--no_feature_cache", default=False, action='store_true')
+    parser.add_argument("--preprocess_workers", default=1, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(args.data_dir, "cache")
+    if args.pack_length is None:
+        args.pack_length = args.max_seq_length
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+    processor = run_classifier.c3Processor(args.data_dir)
+    data = run_classifier.load_features(processor, args.split, processor.get_labels(), tokenizer, args)
+    collates = [("padded", feature_store.trim_collate),
+                ("packed", functools.partial(feature_store.pack_collate, pack_length=args.pack_length))]
+
+    # Tokens and attention scores computed over the whole split.
+    print("%s: %d questions, batches of %d, rows of %d tokens" % (
+        args.split, len(data), args.batch_size, args.pack_length))
+    for name, collate_fn in collates:
+        rows, tokens, real_tokens, scores = 0, 0, 0, 0
+        for batch in DataLoader(data, sampler=SequentialSampler(data), batch_size=args.batch_size,
+                                collate_fn=collate_fn):
+            # The second field is the input mask, or the sequence ids of the packed rows.
+            input_ids, input_mask = batch[0], batch[1]
+            input_ids = input_ids.view(-1, input_ids.size(-1))
+            rows += input_ids.size(0)
+            tokens += input_ids.numel()
+            real_tokens += int((input_mask > 0).sum())
+            scores += input_ids.size(0) * input_ids.size(1) ** 2
+        print("%-7s %8d rows %12d tokens (%5.1f%% padding) %14d attention scores" % (
+            name, rows, tokens, 100.0 * (1 - real_tokens / max(tokens, 1)), scores))
+
+    config = BertConfig.from_json_file(args.bert_config_file)
+    torch.manual_seed(args.seed)
+    model = BertForSequenceClassification(config, 1)
+    if args.init_checkpoint:
+        model.bert.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'))
+    model.to(device)
+
+    logits, seconds = {}, {}
+    for name, collate_fn in collates:
+        batches = []
+        for batch in DataLoader(data, sampler=SequentialSampler(data), batch_size=args.batch_size,
+                                collate_fn=collate_fn):
+            batches.append(batch)
+            if len(batches) == args.max_batches:
+                break
+        model.eval()
+        with torch.no_grad():
+            outputs = []
+            for b in batches:
+                inputs, kwargs = batch_inputs(b, name == "packed", device)
+                outputs.append(model(*inputs, **kwargs)[1].cpu())
+            logits[name] = torch.cat(outputs)
+        # The learning rate is 0, so both collates train the same weights.
+        model.train()
+        optimizer = BERTAdam(model.parameters(), lr=0.0)
+        start = time.time()
+        for b in batches:
+            inputs, kwargs = batch_inputs(b, name == "packed", device)
+            loss, _ = model(*inputs, **kwargs)
+            loss.backward()
+            optimizer.step()
+            model.zero_grad()
+        seconds[name] = time.time() - start
+    print("max |dlogit| over %d questions: %.3g" % (
+        len(logits["padded"]), (logits["padded"] - logits["packed"]).abs().max()))
+    print("training: padded %.2fs, packed %.2fs (%.2fx)" % (
+        seconds["padded"], seconds["packed"], seconds["padded"] / seconds["packed"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# coding=utf-8
+"""Accuracy parity and throughput of the precision modes of `run_classifier.py`.
+
+Scores the C3 dev set with the same weights at every precision, reports the
+accuracy, the largest logit difference and the prediction agreement against
+fp32, and times evaluation and training steps:
+
+    python benchmarks/bench_precision.py --data_dir ../data \
+        --bert_config_file ../chinese_L-12_H-768_A-12/bert_config.json \
+        --vocab_file ../chinese_L-12_H-768_A-12/vocab.txt \
+        --classifier_checkpoint ../output/model_best.pt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, SequentialSampler, Subset
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feature_store
+import modeling
+import run_classifier
+import tokenization
+from modeling import BertConfig, BertForSequenceClassification
+from optimization import BERTAdam
+
+
+def build_model(args, config, precision, device):
+    torch.manual_seed(args.seed)
+    model = BertForSequenceClassification(config, 1)
+    if args.classifier_checkpoint:
+        model.load_state_dict(torch.load(args.classifier_checkpoint, map_location='cpu')['model'])
+    elif args.init_checkpoint:
+        model.bert.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'))
+    return model.to(device=device, dtype=modeling.parameter_dtype(precision))
+
+
+def time_training(model, dataloader, precision, device, steps):
+    """Runs `steps` forward/backward/update steps; returns questions per second."""
+    optimizer = BERTAdam(model.parameters(), lr=1e-5, master_weights=precision == "pure_bf16")
+    model.train()
+    batches = []
+    while len(batches) < steps:
+        batches.extend(dataloader)
+    num_questions = 0
+    start = time.time()
+    for batch in batches[:steps]:
+        input_ids, input_mask, segment_ids, label_ids = (t.to(device).long() for t in batch)
+        with modeling.autocast(device, precision):
+            loss, _ = model(input_ids, segment_ids, input_mask, label_ids, run_classifier.n_class)
+        loss.backward()
+        optimizer.step()
+        model.zero_grad()
+        num_questions += input_ids.size(0)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return num_questions / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="../data", type=str)
+    parser.add_argument("--bert_config_file", default=None, type=str, required=True)
+    parser.add_argument("--vocab_file", default=None, type=str, required=True)
+    parser.add_argument("--init_checkpoint", default=None, type=str,
+                        help="Pre-trained BERT weights. Parity is more telling with --classifier_checkpoint.")
+    parser.add_argument("--classifier_checkpoint", default=None, type=str,
+                        help="A model_best.pt written by run_classifier.py.")
+    parser.add_argument("--precisions", default="fp32,bf16,pure_bf16", type=str,
+                        help="Comma-separated precisions to compare; the first one is the reference.")
+    parser.add_argument("--max_seq_length", default=512, type=int)
+    parser.add_argument("--eval_batch_size", default=8, type=int)
+    parser.add_argument("--max_questions", default=None, type=int,
+                        help="Only score the first questions of the dev set.")
+    parser.add_argument("--train_steps", default=10, type=int,
+                        help="Number of training steps timed at every precision. 0 skips them.")
+    parser.add_argument("--do_lower_case", default=False, action='store_true',
+                        help="As given to run_classifier.py when training.")
+    parser.add_argument("--cache_dir", default=None, type=str)
+    parser.add_argument("--no_feature_cache", default=False, action='store_true')
+    parser.add_argument("--preprocess_workers", default=1, type=int)
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(args.data_dir, "cache")
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    config = BertConfig.from_json_file(args.bert_config_file)
+    tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+    processor = run_classifier.c3Processor(args.data_dir)
+    dev_data = run_classifier.load_features(processor, "dev", processor.get_labels(), tokenizer, args)
+    if args.max_questions is not None:
+        dev_data = Subset(dev_data, range(min(args.max_questions, len(dev_data))))
+    dataloader = DataLoader(dev_data, sampler=SequentialSampler(dev_data), batch_size=args.eval_batch_size,
+                            collate_fn=feature_store.trim_collate)
+    print("device %s, %d dev questions, %d threads" % (device, len(dev_data), torch.get_num_threads()))
+
+    reference = None
+    print("%-10s %9s %12s %10s %12s %12s" % (
+        "precision", "accuracy", "max |dlogit|", "agreement", "eval q/s", "train q/s"))
+    for precision in args.precisions.split(","):
+        model = build_model(args, config, precision, device)
+        start = time.time()
+        result = run_classifier.evaluate(model, dataloader, device, precision=precision)
+        eval_speed = len(result.labels) / (time.time() - start)
+        if reference is None:
+            reference = result
+        max_diff = np.abs(result.logits - reference.logits).max()
+        agreement = np.mean(result.logits.argmax(1) == reference.logits.argmax(1))
+        train_speed = time_training(model, dataloader, precision, device, args.train_steps) \
+            if args.train_steps > 0 else float("nan")
+        print("%-10s %9.4f %12.4g %10.4f %12.2f %12.2f" % (
+            precision, result.accuracy, max_diff, agreement, eval_speed, train_speed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+"""Check of `feature_store.LengthGroupedSampler` batches and the padding they save.
+
+Draws batches through a `DataLoader` for several dataset sizes, including sizes
+that are not a multiple of the batch size, and fails if any batch is larger
+than the batch size, if the batches do not cover every question exactly once,
+or if the median length spread of the batches grows once a window has a
+shorter last batch. Question lengths come from the C3 train split when
+--vocab_file is given, and are drawn at random otherwise:
+
+    python benchmarks/bench_sampler.py --data_dir ../data \
+        --vocab_file ../chinese_L-12_H-768_A-12/vocab.txt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feature_store
+import run_classifier
+import tokenization
+
+
+def c3_lengths(args):
+    """Token length of the longest choice sequence of every train question, as `run_classifier.py` truncates it."""
+    tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+    lengths = []
+    for d in run_classifier.c3Processor(args.data_dir).iter_questions("train"):
+        document, question = len(tokenizer.encode(d[0])), len(tokenizer.encode(d[1]))
+        choice = max(len(tokenizer.encode(c)) for c in d[2:6])
+        lengths.append(min(document + question + choice + 3, args.max_seq_length))
+        if len(lengths) == args.max_questions:
+            break
+    return np.array(lengths)
+
+
+def random_lengths(args):
+    rng = np.random.RandomState(0)
+    return np.clip(rng.lognormal(5.0, 0.8, args.max_questions).astype(np.int64), 16, args.max_seq_length)
+
+
+def batch_spreads(lengths, num_questions, batch_size):
+    """Draws one epoch over the first `num_questions` questions; returns the length spread of every batch."""
+    sampler = feature_store.LengthGroupedSampler(lengths, batch_size, np.arange(num_questions))
+    dataloader = DataLoader(np.arange(len(lengths)), batch_sampler=sampler)
+    batches = [batch.numpy() for batch in dataloader]
+    seen = np.concatenate(batches)
+    assert len(batches) == len(sampler), "%d batches, but len(sampler) is %d" % (len(batches), len(sampler))
+    assert max(len(batch) for batch in batches) <= batch_size, "a batch is larger than the batch size"
+    assert np.array_equal(np.sort(seen), np.arange(num_questions)), "the batches do not cover every question once"
+    spreads = np.array([lengths[batch].max() - lengths[batch].min() for batch in batches])
+    padding = sum(len(batch) * lengths[batch].max() - lengths[batch].sum() for batch in batches)
+    return spreads, padding / float(lengths[:num_questions].sum())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="../data", type=str)
+    parser.add_argument("--vocab_file", default=None, type=str,
+                        help="Vocab to measure the C3 train questions with. Random lengths are used when not given.")
+    parser.add_argument("--do_lower_case", default=False, action='store_true')
+    parser.add_argument("--max_seq_length", default=512, type=int)
+    parser.add_argument("--max_questions", default=4000, type=int,
+                        help="Number of questions whose lengths are used.")
+    parser.add_argument("--batch_size", default=16, type=int)
+    parser.add_argument("--num_questions", default="960,961,1000,1030,3999", type=str,
+                        help="Comma-separated dataset sizes to draw batches for; the first should be a multiple "
+                             "of --batch_size.")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    lengths = c3_lengths(args) if args.vocab_file else random_lengths(args)
+    print("%d questions, mean length %.1f" % (len(lengths), lengths.mean()))
+    print("%-10s %10s %10s %10s %10s" % ("questions", "batches", "p50 spread", "max spread", "padding"))
+    baseline = None
+    failures = 0
+    for num_questions in [int(x) for x in args.num_questions.split(",")]:
+        spreads, padding = batch_spreads(lengths, min(num_questions, len(lengths)), args.batch_size)
+        median = np.median(spreads)
+        print("%-10d %10d %10.1f %10d %9.1f%%" % (num_questions, len(spreads), median, spreads.max(), padding * 100))
+        if baseline is None:
+            baseline = median
+        elif median > 2 * baseline + 2:
+            print("median spread %.1f at %d questions is far above %.1f at a multiple of the batch size" % (
+                median, num_questions, baseline))
+            failures += 1
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# coding=utf-8
+"""Latency and throughput of `serve_c3.py` under concurrent clients.
+
+Every client thread sends C3 dev questions one after the other, and the
+latencies of all requests are summarized for each micro-batching setting
+(`max_batch_questions:max_latency_ms`). The first setting, 1:0, scores every
+request on its own:
+
+    python benchmarks/bench_serve.py --data_dir ../data \
+        --bert_config_file ../chinese_L-12_H-768_A-12/bert_config.json \
+        --vocab_file ../chinese_L-12_H-768_A-12/vocab.txt \
+        --checkpoint ../c3_curriculumLearning/model_best.pt --clients 16
+
+With --url, requests go over HTTP to a running `serve_c3.py` instead, whose
+own settings then apply.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import run_classifier
+import serve_c3
+import tokenization
+
+
+def load_requests(args):
+    requests = []
+    for d in run_classifier.c3Processor(args.data_dir).iter_questions("dev"):
+        requests.append({"document": d[0], "question": d[1], "choices": [c for c in d[2:6] if c]})
+        if len(requests) == args.max_questions:
+            break
+    return requests
+
+
+def http_score(url, request):
+    data = json.dumps(request).encode("utf-8")
+    with urllib.request.urlopen(urllib.request.Request(url, data=data)) as response:
+        return json.loads(response.read().decode("utf-8"))
+
+
+def run_clients(score_fn, requests, num_clients):
+    """Sends `requests` from `num_clients` threads; returns the latencies in seconds and the wall time."""
+    latencies = [None] * len(requests)
+
+    def client(first):
+        for i in range(first, len(requests), num_clients):
+            start = time.time()
+            score_fn(requests[i])
+            latencies[i] = time.time() - start
+
+    start = time.time()
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return np.array(latencies), time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="../data", type=str)
+    parser.add_argument("--bert_config_file", default=None, type=str)
+    parser.add_argument("--vocab_file", default=None, type=str)
+    parser.add_argument("--checkpoint", default=None, type=str,
+                        help="A model_best.pt written by run_classifier.py.")
+    parser.add_argument("--url", default=None, type=str,
+                        help="Score over HTTP at this URL, e.g. http://127.0.0.1:8000/score, instead of in process.")
+    parser.add_argument("--settings", default="1:0,8:5,8:20", type=str,
+                        help="Comma-separated max_batch_questions:max_latency_ms settings.")
+    parser.add_argument("--clients", default=8, type=int,
+                        help="Number of concurrent client threads.")
+    parser.add_argument("--max_questions", default=200, type=int,
+                        help="Number of dev questions sent per setting.")
+    parser.add_argument("--max_seq_length", default=512, type=int)
+    parser.add_argument("--do_lower_case", default=False, action='store_true',
+                        help="As given to run_classifier.py when training.")
+    parser.add_argument("--shared_doc_layers", default=0, type=int)
+    parser.add_argument("--no_pack_sequences", default=False, action='store_true')
+    parser.add_argument("--precision", default="fp32", choices=serve_c3.modeling.PRECISIONS)
+    parser.add_argument("--attention_backend", default=None, choices=serve_c3.modeling.ATTENTION_BACKENDS)
+    parser.add_argument("--no_cuda", default=False, action='store_true')
+    args = parser.parse_args()
+
+    requests = load_requests(args)
+    if args.url:
+        targets = [("http", lambda request: http_score(args.url, request), None)]
+    else:
+        if not (args.bert_config_file and args.vocab_file and args.checkpoint):
+            parser.error("--bert_config_file, --vocab_file and --checkpoint are needed without --url")
+        device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+        tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+        pack_length = None if args.no_pack_sequences or args.shared_doc_layers > 0 else args.max_seq_length
+        scorer = serve_c3.C3Scorer(serve_c3.load_model(args, device), tokenizer, device,
+                                   max_seq_length=args.max_seq_length, precision=args.precision,
+                                   pack_length=pack_length)
+        targets = []
+        for setting in args.settings.split(","):
+            max_batch_questions, max_latency_ms = setting.split(":")
+            service = serve_c3.C3Service(scorer, max_batch_questions=int(max_batch_questions),
+                                         max_latency_ms=float(max_latency_ms))
+            targets.append((setting, lambda request, service=service: service.submit(request).result(), service))
+
+    print("%d questions, %d clients" % (len(requests), args.clients))
+    print("%-10s %10s %10s %10s %10s" % ("setting", "q/s", "p50 ms", "p99 ms", "max ms"))
+    for name, score_fn, service in targets:
+        # One warm-up pass over a few requests.
+        run_clients(score_fn, requests[:args.clients], args.clients)
+        latencies, seconds = run_clients(score_fn, requests, args.clients)
+        if service is not None:
+            service.close()
+        print("%-10s %10.2f %10.1f %10.1f %10.1f" % (
+            name, len(requests) / seconds, np.percentile(latencies, 50) * 1000,
+            np.percentile(latencies, 99) * 1000, latencies.max() * 1000))
+
+
+if __name__ == "__main__":
+    main()
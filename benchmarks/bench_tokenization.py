@@ -0,0 +1,274 @@
+# coding=utf-8
+"""Parity check and benchmark of `tokenization.BasicTokenizer` and `WordpieceTokenizer`.
+
+Tokenizes every string in the C3 JSON files with the table-driven basic
+tokenizer and the trie-based WordPiece tokenizer, and with copies of the
+original implementations, and fails if any output differs:
+
+    python benchmarks/bench_tokenization.py --data_dir ../data \
+        --vocab_file ../chinese_L-12_H-768_A-12/vocab.txt
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import random
+import sys
+import time
+import unicodedata
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tokenization
+
+
+class ReferenceBasicTokenizer(object):
+    """The per-character `BasicTokenizer` the table-driven one must match."""
+
+    def __init__(self, do_lower_case=True):
+        self.do_lower_case = do_lower_case
+
+    def tokenize(self, text):
+        text = tokenization.convert_to_unicode(text)
+        text = self._clean_text(text)
+        text = self._tokenize_chinese_chars(text)
+        orig_tokens = tokenization.whitespace_tokenize(text)
+        split_tokens = []
+        for token in orig_tokens:
+            if self.do_lower_case:
+                token = token.lower()
+                token = self._run_strip_accents(token)
+            split_tokens.extend(self._run_split_on_punc(token))
+        return tokenization.whitespace_tokenize(" ".join(split_tokens))
+
+    def _run_strip_accents(self, text):
+        text = unicodedata.normalize("NFD", text)
+        return "".join(char for char in text if unicodedata.category(char) != "Mn")
+
+    def _run_split_on_punc(self, text):
+        start_new_word = True
+        output = []
+        for char in text:
+            if tokenization._is_punctuation(char):
+                output.append([char])
+                start_new_word = True
+            else:
+                if start_new_word:
+                    output.append([])
+                start_new_word = False
+                output[-1].append(char)
+        return ["".join(x) for x in output]
+
+    def _tokenize_chinese_chars(self, text):
+        output = []
+        for char in text:
+            cp = ord(char)
+            if ((cp >= 0x4E00 and cp <= 0x9FFF) or (cp >= 0x3400 and cp <= 0x4DBF) or
+                    (cp >= 0x20000 and cp <= 0x2A6DF) or (cp >= 0x2A700 and cp <= 0x2B73F) or
+                    (cp >= 0x2B740 and cp <= 0x2B81F) or (cp >= 0x2B820 and cp <= 0x2CEAF) or
+                    (cp >= 0xF900 and cp <= 0xFAFF) or (cp >= 0x2F800 and cp <= 0x2FA1F)):
+                output.extend([" ", char, " "])
+            else:
+                output.append(char)
+        return "".join(output)
+
+    def _clean_text(self, text):
+        output = []
+        for char in text:
+            cp = ord(char)
+            if cp == 0 or cp == 0xfffd or tokenization._is_control(char):
+                continue
+            if tokenization._is_whitespace(char):
+                output.append(" ")
+            else:
+                output.append(char)
+        return "".join(output)
+
+
+class ReferenceWordpieceTokenizer(object):
+    """The `WordpieceTokenizer` that probes the vocab with every shrinking substring."""
+
+    def __init__(self, vocab, unk_token="[UNK]", max_input_chars_per_word=200):
+        self.vocab = vocab
+        self.unk_token = unk_token
+        self.max_input_chars_per_word = max_input_chars_per_word
+
+    def tokenize(self, text):
+        output_tokens = []
+        for token in tokenization.whitespace_tokenize(text):
+            chars = list(token)
+            if len(chars) > self.max_input_chars_per_word:
+                output_tokens.append(self.unk_token)
+                continue
+            is_bad = False
+            start = 0
+            sub_tokens = []
+            while start < len(chars):
+                end = len(chars)
+                cur_substr = None
+                while start < end:
+                    substr = "".join(chars[start:end])
+                    if start > 0:
+                        substr = "##" + substr
+                    if substr in self.vocab:
+                        cur_substr = substr
+                        break
+                    end -= 1
+                if cur_substr is None:
+                    is_bad = True
+                    break
+                sub_tokens.append(cur_substr)
+                start = end
+            if is_bad:
+                output_tokens.append(self.unk_token)
+            else:
+                output_tokens.extend(sub_tokens)
+        return output_tokens
+
+
+def collect_strings(obj, out):
+    """Appends every string nested in a parsed JSON value to `out`."""
+    if isinstance(obj, str):
+        out.append(obj)
+    elif isinstance(obj, list):
+        for item in obj:
+            collect_strings(item, out)
+    elif isinstance(obj, dict):
+        for item in obj.values():
+            collect_strings(item, out)
+    return out
+
+
+def random_strings(num_strings, seed=0):
+    """Strings of random codepoints from every plane, to exercise the rare classes."""
+    rng = random.Random(seed)
+    strings = []
+    for _ in range(num_strings):
+        chars = []
+        for _ in range(rng.randint(1, 64)):
+            if rng.random() < 0.5:
+                chars.append(chr(rng.randint(0, 0x2FFF)))
+            else:
+                chars.append(chr(rng.randint(0, sys.maxunicode)))
+        strings.append("".join(chars))
+    return strings
+
+
+def all_codepoint_strings(chunk_size=64):
+    """Every codepoint once, in strings of `chunk_size` consecutive codepoints."""
+    return ["".join(chr(cp) for cp in range(start, min(start + chunk_size, sys.maxunicode + 1)))
+            for start in range(0, sys.maxunicode + 1, chunk_size)]
+
+
+def long_words(vocab, num_words, seed=0):
+    """Words of up to 200 characters glued together from random vocab pieces."""
+    rng = random.Random(seed)
+    pieces = [token for token in vocab if token and not token.startswith("[")]
+    words = []
+    for _ in range(num_words):
+        word = ""
+        length = rng.randint(20, 200)
+        while len(word) < length:
+            word += rng.choice(pieces).replace("##", "")
+        words.append(word[:200])
+    return words
+
+
+def time_tokenizer(tokenizer, texts):
+    start = time.time()
+    outputs = [tokenizer.tokenize(text) for text in texts]
+    return outputs, time.time() - start
+
+
+def compare(name, reference, fast, texts):
+    """Runs both tokenizers over `texts`; returns the fast outputs and the number of mismatches."""
+    expected, reference_time = time_tokenizer(reference, texts)
+    actual, fast_time = time_tokenizer(fast, texts)
+    mismatches = 0
+    for text, a, b in zip(texts, expected, actual):
+        if a != b:
+            mismatches += 1
+            if mismatches <= 10:
+                print("mismatch on %r:\n  expected %r\n  actual   %r" % (text, a, b))
+    print("%s: reference %.2fs, fast %.2fs (%.1fx)" % (
+        name, reference_time, fast_time, reference_time / max(fast_time, 1e-9)))
+    return actual, mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default="../data", type=str,
+                        help="Directory with the C3 JSON files.")
+    parser.add_argument("--num_random", default=20000, type=int,
+                        help="Number of random codepoint strings checked on top of the data.")
+    parser.add_argument("--all_codepoints", default=False, action='store_true',
+                        help="Whether to also check strings covering every Unicode codepoint.")
+    parser.add_argument("--vocab_file", default=None, type=str,
+                        help="Vocab to check WordpieceTokenizer with. It is skipped when not given.")
+    parser.add_argument("--num_long_words", default=2000, type=int,
+                        help="Number of long words made of vocab pieces checked by WordpieceTokenizer.")
+    parser.add_argument("--num_workers", default="1,2,4", type=str,
+                        help="Comma-separated worker counts FullTokenizer.encode_batch is timed with.")
+    args = parser.parse_args()
+
+    texts = []
+    for path in sorted(glob.glob(os.path.join(args.data_dir, "*.json"))):
+        with open(path, "r", encoding="utf8") as f:
+            collect_strings(json.load(f), texts)
+    print("%d strings, %d characters from %s" % (len(texts), sum(len(t) for t in texts), args.data_dir))
+    data_texts = list(texts)
+    texts += random_strings(args.num_random)
+    if args.all_codepoints:
+        texts += all_codepoint_strings()
+
+    mismatches = 0
+    for do_lower_case in (True, False):
+        basic_tokens, n = compare("BasicTokenizer(do_lower_case=%s)" % do_lower_case,
+                                  ReferenceBasicTokenizer(do_lower_case),
+                                  tokenization.BasicTokenizer(do_lower_case), texts)
+        mismatches += n
+
+    if args.vocab_file:
+        vocab = tokenization.load_vocab(args.vocab_file)
+        start = time.time()
+        wordpiece_tokenizer = tokenization.WordpieceTokenizer(vocab)
+        print("built the WordPiece tries in %.2fs" % (time.time() - start))
+        words = [word for tokens in basic_tokens for word in tokens]
+        _, n = compare("WordpieceTokenizer", ReferenceWordpieceTokenizer(vocab), wordpiece_tokenizer, words)
+        mismatches += n
+        # Words that are not a piece themselves are where the longest-match search runs.
+        words = [word for word in words if word not in vocab]
+        _, n = compare("WordpieceTokenizer, %d out-of-vocab words" % len(words),
+                       ReferenceWordpieceTokenizer(vocab), wordpiece_tokenizer, words)
+        mismatches += n
+        _, n = compare("WordpieceTokenizer, %d long words" % args.num_long_words,
+                       ReferenceWordpieceTokenizer(vocab), wordpiece_tokenizer,
+                       long_words(vocab, args.num_long_words))
+        mismatches += n
+
+        full_tokenizer = tokenization.FullTokenizer(args.vocab_file)
+        expected = None
+        for num_workers in [int(x) for x in args.num_workers.split(",")]:
+            start = time.time()
+            ids = full_tokenizer.encode_batch(data_texts, num_workers=num_workers)
+            print("FullTokenizer.encode_batch, %d workers: %.2fs" % (num_workers, time.time() - start))
+            if expected is None:
+                expected = [full_tokenizer.convert_tokens_to_ids(full_tokenizer.tokenize(text))
+                            for text in data_texts]
+            if [list(x) for x in ids] != expected:
+                print("encode_batch with %d workers differs from tokenize" % num_workers)
+                mismatches += 1
+
+    if mismatches:
+        print("%d mismatches" % mismatches)
+        sys.exit(1)
+    print("outputs identical")
+
+
+if __name__ == "__main__":
+    main()
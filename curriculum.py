@@ -0,0 +1,135 @@
+# coding=utf-8
+"""Curriculum schedules over the difficulty buckets used by `run_classifier.py`.
+
+The buckets are packed easiest first into one store, so a schedule only has to
+pick which rows of the store to train on in each epoch.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+
+import numpy as np
+
+
+class CurriculumScheduler(object):
+    """Base class: chooses the rows of the bucket store used in each epoch.
+
+    Args:
+        cumulative_sizes: number of rows in buckets 0..j, for every bucket j.
+        epochs_per_stage: how many epochs a stage of the curriculum lasts.
+    """
+
+    def __init__(self, cumulative_sizes, epochs_per_stage=2):
+        self.cumulative_sizes = list(cumulative_sizes)
+        self.num_buckets = len(self.cumulative_sizes)
+        self.num_rows = self.cumulative_sizes[-1]
+        self.epochs_per_stage = epochs_per_stage
+
+    def bucket_rows(self, bucket):
+        start = self.cumulative_sizes[bucket - 1] if bucket > 0 else 0
+        return np.arange(start, self.cumulative_sizes[bucket])
+
+    def epoch_indices(self, epoch):
+        """Returns the store rows to sample from in `epoch`."""
+        raise NotImplementedError()
+
+
+class FullScheduler(CurriculumScheduler):
+    """No curriculum: every epoch sees all buckets."""
+
+    def epoch_indices(self, epoch):
+        return np.arange(self.num_rows)
+
+
+class BabyStepScheduler(CurriculumScheduler):
+    """Adds one harder bucket every `epochs_per_stage` epochs (Spitkovsky et al., 2010)."""
+
+    def epoch_indices(self, epoch):
+        stage = min(epoch // self.epochs_per_stage, self.num_buckets - 1)
+        return np.arange(self.cumulative_sizes[stage])
+
+
+class OscillatingScheduler(CurriculumScheduler):
+    """Grows the training set one bucket per stage up to all buckets, then shrinks it back."""
+
+    def epoch_indices(self, epoch):
+        period = 2 * (self.num_buckets - 1)
+        phase = (epoch // self.epochs_per_stage) % period if period else 0
+        stage = phase if phase < self.num_buckets else period - phase
+        return np.arange(self.cumulative_sizes[stage])
+
+
+class CompetenceScheduler(CurriculumScheduler):
+    """Competence-based curriculum (Platanios et al., 2019).
+
+    At epoch t the model may see the easiest `c(t)` fraction of the store, where
+    c(t) = min(1, t * (1 - c0) / T + c0) for linear pacing and
+    c(t) = min(1, sqrt(t * (1 - c0^2) / T + c0^2)) for square-root pacing.
+    """
+
+    def __init__(self, cumulative_sizes, pacing="sqrt", c0=0.01, total_epochs=10, **kwargs):
+        super(CompetenceScheduler, self).__init__(cumulative_sizes, **kwargs)
+        if pacing not in ("linear", "sqrt"):
+            raise ValueError("Invalid pacing function: {}".format(pacing))
+        self.pacing = pacing
+        self.c0 = c0
+        self.total_epochs = max(total_epochs, 1)
+
+    def competence(self, epoch):
+        if self.pacing == "linear":
+            c = epoch * (1.0 - self.c0) / self.total_epochs + self.c0
+        else:
+            c = math.sqrt(epoch * (1.0 - self.c0 ** 2) / self.total_epochs + self.c0 ** 2)
+        return min(1.0, c)
+
+    def epoch_indices(self, epoch):
+        num_rows = int(math.ceil(self.competence(epoch) * self.num_rows))
+        return np.arange(max(num_rows, 1))
+
+
+class AnnealingScheduler(CurriculumScheduler):
+    """Curriculum annealing (Xu et al., 2020).
+
+    Stage i trains on bucket i plus a random 1/num_buckets share of every
+    easier bucket, re-drawn each epoch; after the last bucket all rows are used.
+    """
+
+    def __init__(self, cumulative_sizes, seed=42, **kwargs):
+        super(AnnealingScheduler, self).__init__(cumulative_sizes, **kwargs)
+        self.seed = seed
+
+    def epoch_indices(self, epoch):
+        stage = epoch // self.epochs_per_stage
+        if stage >= self.num_buckets:
+            return np.arange(self.num_rows)
+        rng = np.random.RandomState(self.seed + epoch)
+        indices = [self.bucket_rows(stage)]
+        for bucket in range(stage):
+            rows = self.bucket_rows(bucket)
+            indices.append(rng.choice(rows, len(rows) // self.num_buckets, replace=False))
+        return np.concatenate(indices)
+
+
+CURRICULA = ("baby_step", "oscillate", "competence_linear", "competence_sqrt", "annealing", "none")
+
+
+def build_scheduler(name, cumulative_sizes, epochs_per_stage=2, competence_c0=0.01,
+                    competence_epochs=None, seed=42):
+    """Builds the curriculum scheduler called `name` (one of `CURRICULA`)."""
+    if name == "baby_step":
+        return BabyStepScheduler(cumulative_sizes, epochs_per_stage=epochs_per_stage)
+    if name == "oscillate":
+        return OscillatingScheduler(cumulative_sizes, epochs_per_stage=epochs_per_stage)
+    if name in ("competence_linear", "competence_sqrt"):
+        if competence_epochs is None:
+            competence_epochs = epochs_per_stage * len(cumulative_sizes)
+        return CompetenceScheduler(cumulative_sizes, pacing=name[len("competence_"):], c0=competence_c0,
+                                   total_epochs=competence_epochs, epochs_per_stage=epochs_per_stage)
+    if name == "annealing":
+        return AnnealingScheduler(cumulative_sizes, seed=seed, epochs_per_stage=epochs_per_stage)
+    if name == "none":
+        return FullScheduler(cumulative_sizes, epochs_per_stage=epochs_per_stage)
+    raise ValueError("Invalid curriculum: {}".format(name))
@@ -23,12 +23,15 @@ import codecs
 import collections
 import logging
 import json
+import os
+import queue
 import re
+import threading
 
+import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
-from torch.utils.data.distributed import DistributedSampler
 
+import modeling
 import tokenization
 from modeling import BertConfig, BertModel
 
@@ -59,9 +62,13 @@ class InputFeatures(object):
 
 def convert_examples_to_features(examples, seq_length, tokenizer):
     """Loads a data file into a list of `InputBatch`s."""
+    return list(iter_features(examples, seq_length, tokenizer))
 
-    features = []
-    for (ex_index, example) in enumerate(examples):
+
+def iter_features(examples, seq_length, tokenizer):
+    """Yields the `InputFeatures` of `examples` one at a time, consuming them lazily."""
+
+    for example in examples:
         tokens_a = tokenizer.tokenize(example.text_a)
 
         tokens_b = None
@@ -129,7 +136,7 @@ def convert_examples_to_features(examples, seq_length, tokenizer):
         assert len(input_mask) == seq_length
         assert len(input_type_ids) == seq_length
 
-        if ex_index < 5:
+        if example.unique_id < 5:
             logger.info("*** Example ***")
             logger.info("unique_id: %s" % (example.unique_id))
             logger.info("tokens: %s" % " ".join([str(x) for x in tokens]))
@@ -138,14 +145,12 @@ def convert_examples_to_features(examples, seq_length, tokenizer):
             logger.info(
                 "input_type_ids: %s" % " ".join([str(x) for x in input_type_ids]))
 
-        features.append(
-            InputFeatures(
-                unique_id=example.unique_id,
-                tokens=tokens,
-                input_ids=input_ids,
-                input_mask=input_mask,
-                input_type_ids=input_type_ids))
-    return features
+        yield InputFeatures(
+            unique_id=example.unique_id,
+            tokens=tokens,
+            input_ids=input_ids,
+            input_mask=input_mask,
+            input_type_ids=input_type_ids)
 
 
 def _truncate_seq_pair(tokens_a, tokens_b, max_length):
@@ -165,15 +170,367 @@ def _truncate_seq_pair(tokens_a, tokens_b, max_length):
             tokens_b.pop()
 
 
+POOLINGS = ("none", "cls", "mean", "max", "pooler")
+
+
+def pool_features(encoder_layers, pooled_output, input_mask, pooling):
+    """Reduces every sequence to one vector per layer, on the device.
+
+    "cls" takes the [CLS] vector, "mean" and "max" pool over the real tokens of
+    `input_mask`, and "pooler" returns the pooler output instead of any layer.
+    Returns a float32 [batch_size, num_layers, hidden_size] tensor (num_layers is
+    1 for "pooler").
+    """
+    if pooling == "pooler":
+        return pooled_output.float().unsqueeze(1)
+    if pooling == "cls":
+        return torch.stack([layer[:, 0].float() for layer in encoder_layers], dim=1)
+    mask = input_mask.unsqueeze(-1) > 0
+    if pooling == "mean":
+        lengths = mask.sum(1).clamp(min=1)
+        return torch.stack([layer.float().masked_fill(~mask, 0.0).sum(1) / lengths
+                            for layer in encoder_layers], dim=1)
+    if pooling == "max":
+        return torch.stack([layer.float().masked_fill(~mask, float("-inf")).max(1)[0]
+                            for layer in encoder_layers], dim=1)
+    raise ValueError("Invalid pooling: %s - should be one of %s" % (pooling, ", ".join(POOLINGS)))
+
+
+def length_sorted_batches(lengths, batch_size=32, max_tokens=None):
+    """Groups line indices into batches of similar length, longest first.
+
+    Lines are sorted by decreasing length and cut into batches of `batch_size`
+    lines, or, given `max_tokens`, into batches whose padded size (lines times
+    the longest line) fits `max_tokens`. A line longer than `max_tokens` gets a
+    batch of its own. Returns a list of index lists.
+    """
+    batches = []
+    batch = []
+    for index in np.argsort(-np.asarray(lengths), kind="stable"):
+        if batch:
+            # The first line of the batch is its longest.
+            full = len(batch) >= batch_size if max_tokens is None \
+                else (len(batch) + 1) * lengths[batch[0]] > max_tokens
+            if full:
+                batches.append(batch)
+                batch = []
+        batch.append(int(index))
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def iter_batches(examples, tokenizer, seq_length, batch_size=32, max_tokens=None, window_tokens=32768):
+    """Tokenizes `examples` and yields them as length-sorted batches, one window of lines at a time.
+
+    Consecutive lines are gathered until they hold `window_tokens` tokens, and
+    the window is cut into batches by `length_sorted_batches`. The features
+    computed for a window wait to be written in line order, so `window_tokens`
+    bounds the token vectors held at once. Yields (features, input_ids,
+    input_mask), where the tensors are trimmed to the longest line of the batch.
+    """
+    window = []
+    window_length = 0
+    features = iter_features(examples, seq_length, tokenizer)
+    while True:
+        feature = next(features, None)
+        if feature is not None:
+            window.append(feature)
+            window_length += len(feature.tokens)
+            if window_length < window_tokens:
+                continue
+        if not window:
+            break
+        lengths = np.array([len(f.tokens) for f in window])
+        for batch in length_sorted_batches(lengths, batch_size=batch_size, max_tokens=max_tokens):
+            batch_features = [window[i] for i in batch]
+            batch_length = int(lengths[batch[0]])
+            input_ids = torch.tensor([f.input_ids[:batch_length] for f in batch_features], dtype=torch.long)
+            input_mask = torch.tensor([f.input_mask[:batch_length] for f in batch_features], dtype=torch.long)
+            yield batch_features, input_ids, input_mask
+        window = []
+        window_length = 0
+
+
+def prefetch(iterable, max_items):
+    """Iterates `iterable` in a background thread, at most `max_items` ahead of the consumer.
+
+    An exception raised by `iterable` is raised again by the consumer.
+    """
+    items = queue.Queue(maxsize=max_items)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(e)
+            return
+        items.put(done)
+
+    thread = threading.Thread(target=produce, name="prefetch")
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = items.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+    thread.join()
+
+
+def read_progress(progress_file):
+    """Returns the progress saved by a feature writer, or None if there is none."""
+    if not os.path.exists(progress_file):
+        return None
+    with open(progress_file, "r") as reader:
+        return json.load(reader)
+
+
+def write_progress(progress_file, progress):
+    """Replaces `progress_file` atomically, so an interrupted run keeps the previous progress."""
+    tmp = "%s.tmp-%d" % (progress_file, os.getpid())
+    with open(tmp, "w") as writer:
+        json.dump(progress, writer, indent=2)
+    os.replace(tmp, progress_file)
+
+
+def _open_truncated(path, size):
+    """Opens `path` for appending after its first `size` bytes, dropping the rest."""
+    f = open(path, "ab")
+    f.truncate(size)
+    return f
+
+
+def _check_progress(progress, layer_indexes, pooling):
+    if progress["layers"] != layer_indexes or progress["pooling"] != pooling:
+        raise ValueError("Cannot resume features of layers %s pooled with %s as layers %s pooled with %s" % (
+            progress["layers"], progress["pooling"], layer_indexes, pooling))
+
+
+class NpyFeatureWriter(object):
+    """Writes the features of every line to a directory of .npy shards.
+
+    Token vectors of consecutive lines are concatenated into float32 arrays of
+    shape [num_rows, num_layers, hidden_size], one `shard-NNNNN.npy` per about
+    `shard_tokens` rows. A line has one row per token, or a single row with a
+    `pooling` other than "none". `index.npy` holds one (linex_index, shard,
+    offset, num_rows) row per line, `tokens.jsonl` the tokens of every line, and
+    `meta.json` the layers, pooling and shard files. Read them back with
+    `FeatureShards`.
+
+    Only the current shard is kept in memory. After every shard, `progress.json`
+    records the lines written so far; with `resume`, the writer drops whatever
+    was written after them and continues from `num_lines`.
+    """
+
+    def __init__(self, output_dir, layer_indexes, shard_tokens=8192, pooling="none", resume=False):
+        self.output_dir = output_dir
+        self.layer_indexes = list(layer_indexes)
+        self.shard_tokens = shard_tokens
+        self.pooling = pooling
+        self.progress_file = os.path.join(output_dir, "progress.json")
+        self.shards = []
+        self.num_lines = 0
+        self.complete = False
+        self._num_rows = 0
+        self._tokens_bytes = 0
+        self._buffer = []
+        self._buffered_index = []
+        self._buffered_tokens = []
+        self._buffered_rows = 0
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        progress = read_progress(self.progress_file) if resume else None
+        if progress is not None:
+            _check_progress(progress, self.layer_indexes, pooling)
+            self.shards = progress["shards"]
+            self.num_lines = progress["num_lines"]
+            self.complete = progress["complete"]
+            self._num_rows = progress["num_rows"]
+            self._tokens_bytes = progress["tokens_bytes"]
+        if not self.complete:
+            self._index_writer = _open_truncated(os.path.join(output_dir, "index.bin"),
+                                                 self.num_lines * 4 * np.dtype(np.int64).itemsize)
+            self._tokens_writer = _open_truncated(os.path.join(output_dir, "tokens.jsonl"), self._tokens_bytes)
+
+    def write(self, unique_id, tokens, values):
+        """Adds a line; `values` is a [num_rows, num_layers, hidden_size] array."""
+        self._buffered_index.append((unique_id, len(self.shards), self._buffered_rows, len(values)))
+        self._buffered_tokens.append(json.dumps(tokens) + "\n")
+        self._buffer.append(values)
+        self._buffered_rows += len(values)
+        if self._buffered_rows >= self.shard_tokens:
+            self._flush()
+
+    def _flush(self):
+        if not self._buffer:
+            return
+        name = "shard-%05d.npy" % len(self.shards)
+        np.save(os.path.join(self.output_dir, name), np.concatenate(self._buffer).astype(np.float32, copy=False))
+        self._index_writer.write(np.array(self._buffered_index, dtype=np.int64).tobytes())
+        self._index_writer.flush()
+        self._tokens_writer.write("".join(self._buffered_tokens).encode("utf-8"))
+        self._tokens_writer.flush()
+        self.shards.append(name)
+        self.num_lines += len(self._buffered_index)
+        self._num_rows += self._buffered_rows
+        self._tokens_bytes = self._tokens_writer.tell()
+        self._buffer = []
+        self._buffered_index = []
+        self._buffered_tokens = []
+        self._buffered_rows = 0
+        self._save_progress()
+
+    def _save_progress(self):
+        write_progress(self.progress_file, {"layers": self.layer_indexes,
+                                            "pooling": self.pooling,
+                                            "shards": self.shards,
+                                            "num_lines": self.num_lines,
+                                            "num_rows": self._num_rows,
+                                            "tokens_bytes": self._tokens_bytes,
+                                            "complete": self.complete})
+
+    def close(self):
+        self._flush()
+        self._tokens_writer.close()
+        self._index_writer.close()
+        # index.bin is copied page by page into index.npy.
+        index_file = os.path.join(self.output_dir, "index.bin")
+        index = np.lib.format.open_memmap(os.path.join(self.output_dir, "index.npy"), mode="w+",
+                                          dtype=np.int64, shape=(self.num_lines, 4))
+        if self.num_lines:
+            index[:] = np.memmap(index_file, dtype=np.int64, mode="r", shape=(self.num_lines, 4))
+        index.flush()
+        del index
+        os.remove(index_file)
+        meta = {"layers": self.layer_indexes,
+                "pooling": self.pooling,
+                "shards": self.shards,
+                "num_lines": self.num_lines,
+                "num_rows": self._num_rows}
+        with open(os.path.join(self.output_dir, "meta.json"), "w") as writer:
+            json.dump(meta, writer, indent=2)
+        self.complete = True
+        self._save_progress()
+
+
+class JsonlFeatureWriter(object):
+    """Writes the features of every line as one JSON object, with values rounded to 6 digits.
+
+    With a `pooling` other than "none", the object holds the pooled "layers"
+    instead of per-token "features". Every `commit_lines` lines, the number of
+    lines and bytes written is saved to `<output_file>.progress.json`, from
+    which `resume` continues.
+    """
+
+    def __init__(self, output_file, layer_indexes, pooling="none", resume=False, commit_lines=1024):
+        self.layer_indexes = list(layer_indexes)
+        self.pooling = pooling
+        self.commit_lines = commit_lines
+        self.progress_file = output_file + ".progress.json"
+        self.num_lines = 0
+        self.complete = False
+        self._committed_lines = 0
+        self._committed_bytes = 0
+        progress = read_progress(self.progress_file) if resume else None
+        if progress is not None:
+            _check_progress(progress, self.layer_indexes, pooling)
+            self.num_lines = self._committed_lines = progress["num_lines"]
+            self._committed_bytes = progress["bytes"]
+            self.complete = progress["complete"]
+        if not self.complete:
+            self._writer = _open_truncated(output_file, self._committed_bytes)
+
+    def write(self, unique_id, tokens, values):
+        output_json = collections.OrderedDict()
+        output_json["linex_index"] = unique_id
+        if self.pooling != "none":
+            output_json["pooling"] = self.pooling
+            output_json["layers"] = [collections.OrderedDict(
+                [("index", layer_index), ("values", [round(x, 6) for x in values[0, j].tolist()])])
+                for (j, layer_index) in enumerate(self.layer_indexes)]
+        else:
+            all_out_features = []
+            for (i, token) in enumerate(tokens):
+                all_layers = []
+                for (j, layer_index) in enumerate(self.layer_indexes):
+                    layers = collections.OrderedDict()
+                    layers["index"] = layer_index
+                    layers["values"] = [round(x, 6) for x in values[i, j].tolist()]
+                    all_layers.append(layers)
+                out_features = collections.OrderedDict()
+                out_features["token"] = token
+                out_features["layers"] = all_layers
+                all_out_features.append(out_features)
+            output_json["features"] = all_out_features
+        self._writer.write((json.dumps(output_json) + "\n").encode("utf-8"))
+        self.num_lines += 1
+        if self.num_lines - self._committed_lines >= self.commit_lines:
+            self._commit()
+
+    def _commit(self):
+        self._writer.flush()
+        self._committed_lines = self.num_lines
+        self._committed_bytes = self._writer.tell()
+        write_progress(self.progress_file, {"layers": self.layer_indexes,
+                                            "pooling": self.pooling,
+                                            "num_lines": self._committed_lines,
+                                            "bytes": self._committed_bytes,
+                                            "complete": self.complete})
+
+    def close(self):
+        self.complete = True
+        self._commit()
+        self._writer.close()
+
+
+class FeatureShards(object):
+    """Reads the directory written by `NpyFeatureWriter`, memory-mapping the shards."""
+
+    def __init__(self, output_dir):
+        with open(os.path.join(output_dir, "meta.json"), "r") as reader:
+            self.meta = json.load(reader)
+        self.layers = self.meta["layers"]
+        self.index = np.load(os.path.join(output_dir, "index.npy"))
+        self.shards = [np.load(os.path.join(output_dir, name), mmap_mode="r") for name in self.meta["shards"]]
+        self._tokens_file = os.path.join(output_dir, "tokens.jsonl")
+        self._tokens = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def tokens(self, line):
+        if self._tokens is None:
+            with open(self._tokens_file, "r", encoding="utf-8") as reader:
+                self._tokens = [json.loads(l) for l in reader]
+        return self._tokens[line]
+
+    def values(self, line):
+        """The [num_rows, num_layers, hidden_size] features of the `line`-th line written."""
+        _, shard, offset, num_rows = self.index[line]
+        return self.shards[shard][offset:offset + num_rows]
+
+
 def read_examples(input_file):
     """Read a list of `InputExample`s from an input file."""
-    examples = []
+    return list(iter_examples(input_file))
+
+
+def iter_examples(input_file, start_line=0):
+    """Yields the `InputExample`s of an input file one line at a time, from line `start_line`."""
     unique_id = 0
     with open(input_file, "r") as reader:
         while True:
             line = tokenization.convert_to_unicode(reader.readline())
             if not line:
                 break
+            if unique_id < start_line:
+                unique_id += 1
+                continue
             line = line.strip()
             text_a = None
             text_b = None
@@ -183,10 +540,8 @@ def read_examples(input_file):
             else:
                 text_a = m.group(1)
                 text_b = m.group(2)
-            examples.append(
-                InputExample(unique_id=unique_id, text_a=text_a, text_b=text_b))
+            yield InputExample(unique_id=unique_id, text_a=text_a, text_b=text_b)
             unique_id += 1
-    return examples
 
 
 def main():
@@ -196,7 +551,8 @@ def main():
     parser.add_argument("--input_file", default=None, type=str, required=True)
     parser.add_argument("--vocab_file", default=None, type=str, required=True, 
                         help="The vocabulary file that the BERT model was trained on.")
-    parser.add_argument("--output_file", default=None, type=str, required=True)
+    parser.add_argument("--output_file", default=None, type=str, required=True,
+                        help="Directory of the .npy shards, or the JSON lines file with --output_format jsonl.")
     parser.add_argument("--bert_config_file", default=None, type=str, required=True,
                         help="The config json file corresponding to the pre-trained BERT model. "
                             "This specifies the model architecture.")
@@ -211,11 +567,60 @@ def main():
     parser.add_argument("--do_lower_case", default=True, action='store_true', 
                         help="Whether to lower case the input text. Should be True for uncased "
                             "models and False for cased models.")
-    parser.add_argument("--batch_size", default=32, type=int, help="Batch size for predictions.")
+    parser.add_argument("--batch_size", default=32, type=int,
+                        help="Number of lines per batch, unless --max_tokens_per_batch is given.")
+    parser.add_argument("--max_tokens_per_batch",
+                        default=None,
+                        type=int,
+                        help="Fills each batch up to this many tokens, padding included, instead of "
+                             "--batch_size lines.")
     parser.add_argument("--local_rank",
                         type=int,
                         default=-1,
-                        help = "local_rank for distributed training on gpus")
+                        help = "local_rank for distributed training on gpus. Only rank 0 extracts features.")
+    parser.add_argument("--no_cuda",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument("--precision",
+                        default="fp32",
+                        choices=modeling.PRECISIONS,
+                        help="fp32; bf16 to run the model under bfloat16 autocast; or pure_bf16 to also "
+                             "cast the weights to bfloat16. Features are written as float32 either way.")
+    parser.add_argument("--attention_backend",
+                        default=None,
+                        choices=modeling.ATTENTION_BACKENDS,
+                        help="Overrides the attention_backend of the BERT config: eager, or sdpa for "
+                             "PyTorch's fused scaled_dot_product_attention.")
+    parser.add_argument("--output_format",
+                        default="npy",
+                        choices=["npy", "jsonl"],
+                        help="npy writes float32 shards plus an index (see NpyFeatureWriter); jsonl writes "
+                             "one JSON object per line with rounded values, which is much slower.")
+    parser.add_argument("--shard_tokens",
+                        default=8192,
+                        type=int,
+                        help="Approximate number of tokens (or pooled vectors) per .npy shard.")
+    parser.add_argument("--pooling",
+                        default="none",
+                        choices=POOLINGS,
+                        help="none writes every token's vectors; cls, mean and max write one vector per line "
+                             "and layer (mean and max over the real tokens); pooler writes the pooler output "
+                             "and ignores --layers.")
+    parser.add_argument("--sort_window_tokens",
+                        default=32768,
+                        type=int,
+                        help="Number of tokens of consecutive lines sorted by length together. Bounds the "
+                             "features held in memory until their lines can be written in order.")
+    parser.add_argument("--prefetch_batches",
+                        default=8,
+                        type=int,
+                        help="Number of batches tokenized ahead of the model by the background thread.")
+    parser.add_argument("--resume",
+                        default=False,
+                        action='store_true',
+                        help="Continue an interrupted run from the last line saved in the progress file of "
+                             "--output_file.")
 
     args = parser.parse_args()
 
@@ -227,79 +632,77 @@ def main():
         n_gpu = 1
         # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
         torch.distributed.init_process_group(backend='nccl')
-    logger.info("device", device, "n_gpu", n_gpu, "distributed training", bool(args.local_rank != -1))
+    logger.info("device %s n_gpu %d distributed training %r", device, n_gpu, bool(args.local_rank != -1))
+    if args.local_rank != -1 and torch.distributed.get_rank() != 0:
+        # Every process would write the same --output_file, so only the first one extracts.
+        logger.info("Extracting on rank 0 only; rank %d has nothing to do", torch.distributed.get_rank())
+        return
 
     layer_indexes = [int(x) for x in args.layers.split(",")]
 
     bert_config = BertConfig.from_json_file(args.bert_config_file)
+    if args.attention_backend is not None:
+        bert_config.attention_backend = args.attention_backend
 
     tokenizer = tokenization.FullTokenizer(
         vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
 
-    examples = read_examples(args.input_file)
-
-    features = convert_examples_to_features(
-        examples=examples, seq_length=args.max_seq_length, tokenizer=tokenizer)
-
-    unique_id_to_feature = {}
-    for feature in features:
-        unique_id_to_feature[feature.unique_id] = feature
-
     model = BertModel(bert_config)
     if args.init_checkpoint is not None:
         model.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'))
-    model.to(device)
+    model.to(device=device, dtype=modeling.parameter_dtype(args.precision))
 
-    if args.local_rank != -1:
-        model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
-                                                          output_device=args.local_rank)
-    elif n_gpu > 1:
+    if args.local_rank == -1 and n_gpu > 1:
         model = torch.nn.DataParallel(model)
 
-    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
-    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
-    all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-
-    eval_data = TensorDataset(all_input_ids, all_input_mask, all_example_index)
-    if args.local_rank == -1:
-        eval_sampler = SequentialSampler(eval_data)
+    output_layers, output_indexes = layer_indexes, layer_indexes
+    if args.pooling == "pooler":
+        output_layers, output_indexes = "pooled", ["pooler"]
+    if args.output_format == "npy":
+        writer = NpyFeatureWriter(args.output_file, output_indexes, shard_tokens=args.shard_tokens,
+                                  pooling=args.pooling, resume=args.resume)
     else:
-        eval_sampler = DistributedSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.batch_size)
-
+        writer = JsonlFeatureWriter(args.output_file, output_indexes, pooling=args.pooling, resume=args.resume)
+    if writer.complete:
+        logger.info("%s is already complete, with %d lines", args.output_file, writer.num_lines)
+        return
+    if writer.num_lines:
+        logger.info("Resuming %s from line %d", args.output_file, writer.num_lines)
+
+    # Lines are read, tokenized and batched by length in a background thread, one window at a time,
+    # and each batch is trimmed to its longest line.
+    examples = iter_examples(args.input_file, start_line=writer.num_lines)
+    batches = iter_batches(examples, tokenizer, args.max_seq_length, batch_size=args.batch_size,
+                           max_tokens=args.max_tokens_per_batch, window_tokens=args.sort_window_tokens)
+
+    # Features of lines that come out of order wait here until the lines before them are written.
+    pending = {}
+    next_index = writer.num_lines
     model.eval()
-    with open(args.output_file, "w", encoding='utf-8') as writer:
-        for input_ids, input_mask, example_indices in eval_dataloader:
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-
-            all_encoder_layers, _ = model(input_ids, token_type_ids=None, attention_mask=input_mask)
-            all_encoder_layers = all_encoder_layers
-
-            for b, example_index in enumerate(example_indices):
-                feature = features[example_index.item()]
-                unique_id = int(feature.unique_id)
-                # feature = unique_id_to_feature[unique_id]
-                output_json = collections.OrderedDict()
-                output_json["linex_index"] = unique_id
-                all_out_features = []
-                for (i, token) in enumerate(feature.tokens):
-                    all_layers = []
-                    for (j, layer_index) in enumerate(layer_indexes):
-                        layer_output = all_encoder_layers[int(layer_index)].detach().cpu().numpy()
-                        layer_output = layer_output[b]
-                        layers = collections.OrderedDict()
-                        layers["index"] = layer_index
-                        layers["values"] = [
-                            round(x.item(), 6) for x in layer_output[i]
-                        ]
-                        all_layers.append(layers)
-                    out_features = collections.OrderedDict()
-                    out_features["token"] = token
-                    out_features["layers"] = all_layers
-                    all_out_features.append(out_features)
-                output_json["features"] = all_out_features
-                writer.write(json.dumps(output_json) + "\n")
+    for batch_features, input_ids, input_mask in prefetch(batches, args.prefetch_batches):
+        input_ids = input_ids.to(device)
+        input_mask = input_mask.to(device)
+
+        with torch.no_grad(), modeling.autocast(device, args.precision):
+            # Only the requested layers are kept, in the order of --layers.
+            all_encoder_layers, pooled_output = model(input_ids, token_type_ids=None, attention_mask=input_mask,
+                                                      output_layers=output_layers)
+        # One copy of the batch to the host: [batch_size, seq_length, num_layers, hidden_size],
+        # or [batch_size, 1, num_layers, hidden_size] once pooled.
+        if args.pooling == "none":
+            batch_values = torch.stack(all_encoder_layers, dim=2)
+        else:
+            batch_values = pool_features(all_encoder_layers, pooled_output, input_mask, args.pooling).unsqueeze(1)
+        batch_values = batch_values.float().cpu().numpy()
+
+        for b, feature in enumerate(batch_features):
+            values = batch_values[b, :len(feature.tokens)] if args.pooling == "none" else batch_values[b]
+            pending[feature.unique_id] = (feature.tokens, values)
+        while next_index in pending:
+            tokens, values = pending.pop(next_index)
+            writer.write(next_index, tokens, values)
+            next_index += 1
+    writer.close()
 
 
 if __name__ == "__main__":
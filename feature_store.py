@@ -0,0 +1,294 @@
+# coding=utf-8
+"""On-disk cache of multiple-choice features built by `run_classifier.py`.
+
+Features are stored as one flat binary file per field next to a small
+`meta.json` describing shapes and dtypes, so later runs can memory-map them
+instead of re-tokenizing the source JSON. Fields are kept in the narrowest
+dtype that holds them and only widened to int64 on the device, per batch.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, ConcatDataset, Sampler
+from torch.utils.data.dataloader import default_collate
+
+logger = logging.getLogger(__name__)
+
+CACHE_VERSION = 3
+FEATURE_FIELDS = ("input_ids", "input_mask", "segment_ids", "label_id")
+FEATURE_DTYPES = {
+    "input_ids": np.int32,
+    "input_mask": np.uint8,
+    "segment_ids": np.uint8,
+    "label_id": np.int16,
+}
+
+
+def input_ids_dtype(vocab_size):
+    """Returns the narrowest dtype that holds the ids of a vocab of `vocab_size` tokens."""
+    if vocab_size is not None and vocab_size <= np.iinfo(np.int16).max + 1:
+        return np.int16
+    return np.int32
+
+
+def file_digest(path):
+    """Returns the sha1 hex digest of the contents of `path`."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def feature_cache_key(vocab_file, max_seq_length, do_lower_case, source_files, split):
+    """Builds a content-addressed key for the features of one data split."""
+    h = hashlib.sha1()
+    config = {"version": CACHE_VERSION,
+              "max_seq_length": max_seq_length,
+              "do_lower_case": bool(do_lower_case),
+              "split": split}
+    h.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+    h.update(file_digest(vocab_file).encode("utf-8"))
+    for path in source_files:
+        h.update(file_digest(path).encode("utf-8"))
+    return "%s-%s" % (split, h.hexdigest()[:16])
+
+
+def features_to_arrays(features, n_class, num_questions=None, seq_length=None, vocab_size=None):
+    """Converts nested `InputFeatures` lists into a dict of numpy arrays.
+
+    `features` holds one list of `n_class` features per question, as yielded by
+    `iter_features`. Given `num_questions` and `seq_length`, it can be any
+    iterable, e.g. `iter_features` itself, and is consumed one question at a time
+    into preallocated arrays. Given `vocab_size`, input ids are stored as int16
+    when they fit.
+    """
+    if num_questions is None or seq_length is None:
+        features = list(features)
+        num_questions = len(features)
+        seq_length = len(features[0][0].input_ids) if num_questions else 0
+    dtypes = dict(FEATURE_DTYPES, input_ids=input_ids_dtype(vocab_size))
+    arrays = {}
+    for name in ("input_ids", "input_mask", "segment_ids"):
+        arrays[name] = np.zeros((num_questions, n_class, seq_length), dtype=dtypes[name])
+    arrays["label_id"] = np.zeros((num_questions, 1), dtype=dtypes["label_id"])
+
+    num_filled = 0
+    for (i, f) in enumerate(features):
+        for k in range(n_class):
+            arrays["input_ids"][i, k] = f[k].input_ids
+            arrays["input_mask"][i, k] = f[k].input_mask
+            arrays["segment_ids"][i, k] = f[k].segment_ids
+        arrays["label_id"][i, 0] = f[0].label_id
+        num_filled = i + 1
+    if num_filled != num_questions:
+        raise ValueError("Expected features of %d questions, got %d" % (num_questions, num_filled))
+    return arrays
+
+
+def save_feature_arrays(cache_dir, key, arrays):
+    """Writes `arrays` under `cache_dir/key`, replacing the entry atomically."""
+    target = os.path.join(cache_dir, key)
+    tmp = "%s.tmp-%d" % (target, os.getpid())
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+
+    meta = {"version": CACHE_VERSION, "fields": {}}
+    for name in FEATURE_FIELDS:
+        array = np.ascontiguousarray(arrays[name])
+        array.tofile(os.path.join(tmp, name + ".bin"))
+        meta["fields"][name] = {"dtype": array.dtype.str, "shape": list(array.shape)}
+    with open(os.path.join(tmp, "meta.json"), "w") as writer:
+        json.dump(meta, writer, indent=2, sort_keys=True)
+
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    try:
+        os.rename(tmp, target)
+    except OSError:
+        # Another process published the same entry first.
+        shutil.rmtree(tmp, ignore_errors=True)
+    logger.info("Saved features to %s", target)
+
+
+def load_feature_arrays(cache_dir, key, mmap_mode="r"):
+    """Memory-maps the cached arrays for `key`, or returns None on a cache miss."""
+    target = os.path.join(cache_dir, key)
+    meta_file = os.path.join(target, "meta.json")
+    if not os.path.exists(meta_file):
+        return None
+    with open(meta_file, "r") as reader:
+        meta = json.load(reader)
+    if meta.get("version") != CACHE_VERSION:
+        return None
+
+    arrays = {}
+    for name in FEATURE_FIELDS:
+        field = meta["fields"][name]
+        shape = tuple(field["shape"])
+        path = os.path.join(target, name + ".bin")
+        if 0 in shape:
+            arrays[name] = np.zeros(shape, dtype=np.dtype(field["dtype"]))
+        else:
+            arrays[name] = np.memmap(path, dtype=np.dtype(field["dtype"]), mode=mmap_mode, shape=shape)
+    return arrays
+
+
+class FeatureArrayDataset(Dataset):
+    """Serves (input_ids, input_mask, segment_ids, label_id) rows from feature arrays.
+
+    Rows keep the narrow dtypes of the arrays; widen them with `.long()` once
+    they are on the device. A dataset backed by a cache entry (`path`) maps
+    its files on first use and is pickled without them, so DataLoader workers
+    map the same files instead of receiving a copy of the arrays.
+    """
+
+    def __init__(self, arrays=None, path=None):
+        if arrays is None and path is None:
+            raise ValueError("FeatureArrayDataset needs arrays or the path of a cache entry.")
+        self._arrays = arrays
+        self.path = path
+
+    @property
+    def arrays(self):
+        if self._arrays is None:
+            self._arrays = load_feature_arrays(*os.path.split(self.path))
+            if self._arrays is None:
+                raise IOError("No features cached at %s" % self.path)
+        return self._arrays
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state["_arrays"] = None
+        return state
+
+    def __len__(self):
+        return len(self.arrays["label_id"])
+
+    def __getitem__(self, index):
+        return tuple(torch.from_numpy(np.array(self.arrays[name][index])) for name in FEATURE_FIELDS)
+
+    def lengths(self):
+        """Returns the longest real sequence over the choices of every question."""
+        return np.asarray(self.arrays["input_mask"]).sum(-1, dtype=np.int64).max(-1)
+
+
+def feature_lengths(dataset):
+    """Returns per-question lengths of a `FeatureArrayDataset` or a concatenation of them."""
+    if isinstance(dataset, ConcatDataset):
+        return np.concatenate([feature_lengths(d) for d in dataset.datasets])
+    return dataset.lengths()
+
+
+def trim_collate(batch):
+    """Stacks a batch of features and drops the padding columns no choice uses."""
+    input_ids, input_mask, segment_ids, label_id = default_collate(batch)
+    seq_length = max(int(input_mask.sum(-1).max()), 1)
+    return (input_ids[..., :seq_length].contiguous(),
+            input_mask[..., :seq_length].contiguous(),
+            segment_ids[..., :seq_length].contiguous(),
+            label_id)
+
+
+def pack_sequences(input_ids, input_mask, segment_ids, pack_length):
+    """Packs the choice sequences of a batch into rows of at most `pack_length` tokens.
+
+    Sequences are placed longest first into the first row with room left for
+    them. Returns (input_ids, sequence_ids, segment_ids, position_ids, cls_index)
+    where the first four are [num_rows, row_length]: `sequence_ids` numbers the
+    sequences of each row from 1 (0 for padding), `position_ids` restart at 0 for
+    every sequence, and `cls_index` gives, for every input sequence in order, the
+    flat position of its [CLS] token in the packed rows.
+    """
+    seq_length = input_ids.size(-1)
+    input_ids = input_ids.reshape(-1, seq_length)
+    segment_ids = segment_ids.reshape(-1, seq_length)
+    lengths = input_mask.reshape(-1, seq_length).sum(-1).numpy()
+    if lengths.size and lengths.max() > pack_length:
+        raise ValueError("Cannot pack a sequence of %d tokens into rows of %d" % (lengths.max(), pack_length))
+
+    row_fill = []
+    placement = [None] * len(lengths)
+    for i in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[i])
+        for row, fill in enumerate(row_fill):
+            if fill + length <= pack_length:
+                break
+        else:
+            row = len(row_fill)
+            row_fill.append(0)
+        placement[i] = (row, row_fill[row])
+        row_fill[row] += length
+
+    row_length = max(row_fill) if row_fill else 1
+    packed_ids = torch.zeros(len(row_fill), row_length, dtype=input_ids.dtype)
+    sequence_ids = torch.zeros(len(row_fill), row_length, dtype=torch.int16)
+    packed_segment_ids = torch.zeros(len(row_fill), row_length, dtype=segment_ids.dtype)
+    position_ids = torch.zeros(len(row_fill), row_length, dtype=torch.int16)
+    cls_index = torch.zeros(len(lengths), dtype=torch.long)
+    sequences_in_row = [0] * len(row_fill)
+    for i, (row, offset) in enumerate(placement):
+        length = int(lengths[i])
+        end = offset + length
+        sequences_in_row[row] += 1
+        packed_ids[row, offset:end] = input_ids[i, :length]
+        sequence_ids[row, offset:end] = sequences_in_row[row]
+        packed_segment_ids[row, offset:end] = segment_ids[i, :length]
+        position_ids[row, offset:end] = torch.arange(length, dtype=torch.int16)
+        cls_index[i] = row * row_length + offset
+    return packed_ids, sequence_ids, packed_segment_ids, position_ids, cls_index
+
+
+def pack_collate(batch, pack_length):
+    """Stacks a batch of features and packs its choice sequences with `pack_sequences`.
+
+    Returns (input_ids, sequence_ids, segment_ids, position_ids, cls_index, label_id).
+    Use `functools.partial` to bind `pack_length`.
+    """
+    input_ids, input_mask, segment_ids, label_id = default_collate(batch)
+    return pack_sequences(input_ids, input_mask, segment_ids, pack_length) + (label_id,)
+
+
+class LengthGroupedSampler(Sampler):
+    """Samples batches of indices so that each batch holds questions of similar length.
+
+    The indices are shuffled and cut into windows of `batch_size * mega_batch_mult`;
+    each window is sorted by length and split into batches, and the batches are
+    shuffled again so the epoch does not run from short to long questions.
+    Pass it to a `DataLoader` as `batch_sampler`: it yields whole batches, so the
+    shorter last batch of a window does not shift the cut points of later ones.
+    """
+
+    def __init__(self, lengths, batch_size, indices=None, mega_batch_mult=50):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.indices = np.arange(len(self.lengths)) if indices is None else np.asarray(indices)
+        self.mega_batch_mult = mega_batch_mult
+
+    def __len__(self):
+        window = self.batch_size * self.mega_batch_mult
+        full_windows, rest = divmod(len(self.indices), window)
+        return full_windows * self.mega_batch_mult + -(-rest // self.batch_size)
+
+    def __iter__(self):
+        order = self.indices[torch.randperm(len(self.indices)).numpy()]
+        window = self.batch_size * self.mega_batch_mult
+        batches = []
+        for start in range(0, len(order), window):
+            chunk = order[start:start + window]
+            chunk = chunk[np.argsort(-self.lengths[chunk], kind="stable")]
+            batches.extend(chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size))
+        for b in torch.randperm(len(batches)).tolist():
+            yield [int(index) for index in batches[b]]
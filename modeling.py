@@ -18,22 +18,50 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import contextlib
 import copy
 import json
 import math
 import six
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch.nn import CrossEntropyLoss
 from torch.autograd import Variable
 from transformers import AlbertPreTrainedModel, AlbertModel
 
 def gelu(x):
-    """Implementation of the gelu activation function.
+    """Implementation of the gelu activation function, x * 0.5 * (1.0 + erf(x / sqrt(2.0))),
+        with the fused native kernel.
         For information: OpenAI GPT's gelu is slightly different (and gives slightly different results):
         0.5 * x * (1 + torch.tanh(math.sqrt(2 / math.pi) * (x + 0.044715 * torch.pow(x, 3))))
     """
-    return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
+    return F.gelu(x)
+
+
+PRECISIONS = ("fp32", "bf16", "pure_bf16")
+ATTENTION_BACKENDS = ("eager", "sdpa")
+
+
+def autocast(device, precision="fp32"):
+    """Returns the context in which to run the forward pass at `precision` on `device`.
+
+    "fp32" runs everything in float32. "bf16" keeps float32 weights and runs the
+    matmuls under bfloat16 autocast; "pure_bf16" expects the model itself to have
+    been cast to bfloat16 and autocasts the remaining float32 inputs alike. In
+    both, LayerNorm and the attention softmax compute their statistics in float32.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Invalid precision: %s - should be one of %s" % (precision, ", ".join(PRECISIONS)))
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16)
+
+
+def parameter_dtype(precision):
+    """The dtype the model parameters are kept in at `precision`."""
+    return torch.bfloat16 if precision == "pure_bf16" else torch.float32
 
 
 class BertConfig(object):
@@ -50,7 +78,8 @@ class BertConfig(object):
                 attention_probs_dropout_prob=0.1,
                 max_position_embeddings=512,
                 type_vocab_size=16,
-                initializer_range=0.02):
+                initializer_range=0.02,
+                attention_backend="eager"):
         """Constructs BertConfig.
 
         Args:
@@ -74,6 +103,8 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            attention_backend: "eager" to compute attention with explicit matmuls and
+                softmax, or "sdpa" to use PyTorch's fused scaled_dot_product_attention.
         """
         self.vocab_size = vocab_size
         self.hidden_size = hidden_size
@@ -86,6 +117,7 @@ class BertConfig(object):
         self.max_position_embeddings = max_position_embeddings
         self.type_vocab_size = type_vocab_size
         self.initializer_range = initializer_range
+        self.attention_backend = attention_backend
 
     @classmethod
     def from_dict(cls, json_object):
@@ -122,10 +154,11 @@ class BERTLayerNorm(nn.Module):
         self.variance_epsilon = variance_epsilon
 
     def forward(self, x):
-        u = x.mean(-1, keepdim=True)
-        s = (x - u).pow(2).mean(-1, keepdim=True)
-        x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-        return self.gamma * x + self.beta
+        # The native kernel normalizes by the biased variance with epsilon inside the
+        # square root, as the TF layer does. It runs in float32 whatever the input dtype.
+        output = F.layer_norm(x.float(), self.gamma.shape, self.gamma.float(), self.beta.float(),
+                              self.variance_epsilon)
+        return output.to(x.dtype)
 
 class BERTEmbeddings(nn.Module):
     def __init__(self, config):
@@ -141,10 +174,11 @@ class BERTEmbeddings(nn.Module):
         self.LayerNorm = BERTLayerNorm(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)            
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -168,6 +202,12 @@ class BERTSelfAttention(nn.Module):
         self.num_attention_heads = config.num_attention_heads
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
+        self.attention_backend = getattr(config, "attention_backend", "eager")
+        if self.attention_backend not in ATTENTION_BACKENDS:
+            raise ValueError("Invalid attention_backend: %s - should be one of %s" % (
+                self.attention_backend, ", ".join(ATTENTION_BACKENDS)))
+        if self.attention_backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+            raise ValueError("attention_backend sdpa requires PyTorch 2.0 or later.")
 
         self.query = nn.Linear(config.hidden_size, self.all_head_size)
         self.key = nn.Linear(config.hidden_size, self.all_head_size)
@@ -189,20 +229,31 @@ class BERTSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if self.attention_backend == "sdpa":
+            # The fused kernel never materialises the [batch, heads, seq, seq] scores; it
+            # takes the additive mask in the dtype of the queries.
+            context_layer = F.scaled_dot_product_attention(
+                query_layer, key_layer, value_layer, attn_mask=attention_mask.to(query_layer.dtype),
+                dropout_p=self.dropout.p if self.training else 0.0)
+            return self._merge_heads(context_layer)
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         attention_scores = torch.matmul(query_layer, key_layer.transpose(-1, -2))
         attention_scores = attention_scores / math.sqrt(self.attention_head_size)
         # Apply the attention mask is (precomputed for all layers in BertModel forward() function)
         attention_scores = attention_scores + attention_mask
 
-        # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
+        # Normalize the attention scores to probabilities, in float32 under bf16.
+        attention_probs = F.softmax(attention_scores.float(), dim=-1).to(value_layer.dtype)
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
         attention_probs = self.dropout(attention_probs)
 
         context_layer = torch.matmul(attention_probs, value_layer)
+        return self._merge_heads(context_layer)
+
+    def _merge_heads(self, context_layer):
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
@@ -280,14 +331,78 @@ class BERTEncoder(nn.Module):
         super(BERTEncoder, self).__init__()
         layer = BERTLayer(config)
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])    
-
-    def forward(self, hidden_states, attention_mask):
+        self.checkpoint_every = 0
+        self.checkpoint_memory_mb = None
+
+    def set_checkpointing(self, every=0, memory_mb=None):
+        """Configures activation checkpointing of the layers during training.
+
+        A checkpointed layer only keeps its input for the backward pass and runs its
+        forward again to get the rest. `every=k` checkpoints layers 0, k, 2k, ...
+        (every layer with k=1). `memory_mb` instead runs layers normally while the
+        activations they save for backward fit in that many MB. The bytes saved by
+        every layer run normally are measured as it runs; once another layer the
+        size of the last one would exceed the budget, the remaining layers are
+        checkpointed, and only their inputs count against it.
+        """
+        if every < 0:
+            raise ValueError("Invalid checkpoint interval: %d - should be >= 0" % every)
+        if every and memory_mb is not None:
+            raise ValueError("Checkpoint either every k layers or by memory budget, not both.")
+        self.checkpoint_every = every
+        self.checkpoint_memory_mb = memory_mb
+
+    def forward(self, hidden_states, attention_mask, start_layer=0, end_layer=None, output_layers=None):
+        """Runs layers `start_layer` up to (excluding) `end_layer`, all of them by default.
+
+        Returns the outputs of the layers whose index is in `output_layers`, in layer
+        order, or of every layer run when it is None. Other outputs are not kept, so
+        they are freed as soon as the next layer has consumed them.
+        """
+        checkpointing = self.training and torch.is_grad_enabled() and (
+            self.checkpoint_every > 0 or self.checkpoint_memory_mb is not None)
+        budget = None if self.checkpoint_memory_mb is None else self.checkpoint_memory_mb * 2 ** 20
+        saved_bytes, layer_bytes = 0, None
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
-            all_encoder_layers.append(hidden_states)
+        for i, layer_module in enumerate(self.layer[start_layer:end_layer], start_layer):
+            if not checkpointing:
+                hidden_states = layer_module(hidden_states, attention_mask)
+            elif budget is None:
+                if i % self.checkpoint_every == 0:
+                    hidden_states = self._checkpoint(layer_module, hidden_states, attention_mask)
+                else:
+                    hidden_states = layer_module(hidden_states, attention_mask)
+            elif layer_bytes is not None and saved_bytes + layer_bytes > budget:
+                saved_bytes += hidden_states.numel() * hidden_states.element_size()
+                hidden_states = self._checkpoint(layer_module, hidden_states, attention_mask)
+            else:
+                counter = [0]
+                with _count_saved_bytes(counter, layer_module):
+                    hidden_states = layer_module(hidden_states, attention_mask)
+                layer_bytes = counter[0]
+                saved_bytes += layer_bytes
+            if output_layers is None or i in output_layers:
+                all_encoder_layers.append(hidden_states)
         return all_encoder_layers
 
+    @staticmethod
+    def _checkpoint(layer_module, hidden_states, attention_mask):
+        return torch.utils.checkpoint.checkpoint(layer_module, hidden_states, attention_mask, use_reentrant=False)
+
+
+def _count_saved_bytes(counter, module):
+    """Adds to `counter[0]` the bytes of the tensors autograd saves, except `module`'s parameters."""
+    seen = set(p.untyped_storage().data_ptr() for p in module.parameters())
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in seen:
+            seen.add(storage.data_ptr())
+            counter[0] += storage.nbytes()
+        return tensor
+
+    return torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor)
+
 
 class BERTPooler(nn.Module):
     def __init__(self, config):
@@ -320,6 +435,15 @@ class BertModel(nn.Module):
     model = modeling.BertModel(config=config)
     all_encoder_layers, pooled_output = model(input_ids, token_type_ids, input_mask)
     ```
+
+    `output_layers` selects the encoder layers returned: "all" (the default),
+    "last", "pooled" for none of them, or a list of layer indexes, which may be
+    negative as in Python lists. Unselected layers are freed as the encoder runs,
+    so only the selected ones (and the one being computed) stay in memory.
+
+    `attention_mask` is either [batch_size, seq_length], or [batch_size, seq_length,
+    seq_length] to say which tokens each token attends to, e.g. the block-diagonal
+    mask of packed sequences built by `packed_attention_mask`.
     """
     def __init__(self, config: BertConfig):
         """Constructor for BertModel.
@@ -332,18 +456,60 @@ class BertModel(nn.Module):
         self.encoder = BERTEncoder(config)
         self.pooler = BERTPooler(config)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_layers="all",
+                position_ids=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
+        extended_attention_mask = self.get_extended_attention_mask(attention_mask)
+        layer_indexes = self.output_layer_indexes(output_layers)
+
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
+        if layer_indexes is None:
+            all_encoder_layers = self.encoder(embedding_output, extended_attention_mask)
+            pooled_output = self.pooler(all_encoder_layers[-1])
+            return all_encoder_layers, pooled_output
+
+        # The last layer is always kept for the pooler.
+        last_layer = len(self.encoder.layer) - 1
+        kept_layers = sorted(set(layer_indexes) | {last_layer})
+        encoder_layers = self.encoder(embedding_output, extended_attention_mask, output_layers=kept_layers)
+        pooled_output = self.pooler(encoder_layers[-1])
+        encoder_layers = dict(zip(kept_layers, encoder_layers))
+        return [encoder_layers[i] for i in layer_indexes], pooled_output
+
+    def output_layer_indexes(self, output_layers):
+        """Resolves `output_layers` to a list of layer indexes, or None for all layers."""
+        num_layers = len(self.encoder.layer)
+        if output_layers == "all":
+            return None
+        if output_layers == "last":
+            return [num_layers - 1]
+        if output_layers == "pooled":
+            return []
+        if isinstance(output_layers, six.string_types):
+            raise ValueError("Invalid output_layers: %s - should be all, last, pooled or a list of "
+                             "layer indexes" % output_layers)
+        layer_indexes = []
+        for index in output_layers:
+            if not -num_layers <= index < num_layers:
+                raise ValueError("Layer index %d out of range for %d layers" % (index, num_layers))
+            layer_indexes.append(index % num_layers)
+        return layer_indexes
+
+    def get_extended_attention_mask(self, attention_mask):
         # We create a 3D attention mask from a 2D tensor mask.
         # Sizes are [batch_size, 1, 1, to_seq_length]
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        # A 3D [batch_size, from_seq_length, to_seq_length] mask only lacks the heads.
+        if attention_mask.dim() == 3:
+            extended_attention_mask = attention_mask.unsqueeze(1)
+        else:
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -352,12 +518,15 @@ class BertModel(nn.Module):
         # effectively the same as removing these entirely.
         extended_attention_mask = extended_attention_mask.float()
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        return extended_attention_mask
+
+def packed_attention_mask(sequence_ids):
+    """Block-diagonal [rows, seq_length, seq_length] mask letting tokens attend to their own sequence.
+
+    `sequence_ids` numbers the sequences packed in each row from 1, with 0 for padding.
+    """
+    return ((sequence_ids.unsqueeze(2) == sequence_ids.unsqueeze(1)) & (sequence_ids.unsqueeze(1) > 0)).long()
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
-        all_encoder_layers = self.encoder(embedding_output, extended_attention_mask)
-        sequence_output = all_encoder_layers[-1]
-        pooled_output = self.pooler(sequence_output)
-        return all_encoder_layers, pooled_output
 
 class BertForSequenceClassification(nn.Module):
     """BERT model for classification.
@@ -379,9 +548,26 @@ class BertForSequenceClassification(nn.Module):
     model = BertForSequenceClassification(config, num_labels)
     logits = model(input_ids, token_type_ids, input_mask)
     ```
+
+    With `shared_doc_layers=k` and multiple-choice inputs of shape
+    [batch_size, num_choices, seq_length], the document (segment 0) is encoded once
+    per question through the lowest `k` layers while each question+choice suffix
+    (segment 1) is encoded on its own; only the upper layers see the joint
+    sequence, in the spirit of DeFormer (Cao et al., 2020).
+
+    Given `cls_index`, the inputs are rows of packed sequences as built by
+    `feature_store.pack_sequences`: `attention_mask` holds the 1-based sequence
+    ids of every row, `position_ids` restart for every sequence, and `cls_index`
+    is the flat position of the [CLS] token of every choice sequence, in order.
+    Each sequence only attends to itself, so the logits match unpacked inputs.
     """
-    def __init__(self, config, num_labels):
+    def __init__(self, config, num_labels, shared_doc_layers=0):
         super(BertForSequenceClassification, self).__init__()
+        if not 0 <= shared_doc_layers < config.num_hidden_layers:
+            raise ValueError(
+                "shared_doc_layers (%d) should be in [0, num_hidden_layers (%d)[" % (
+                    shared_doc_layers, config.num_hidden_layers))
+        self.shared_doc_layers = shared_doc_layers
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, num_labels)
@@ -398,14 +584,24 @@ class BertForSequenceClassification(nn.Module):
                 module.bias.data.zero_()
         self.apply(init_weights)
 
-    def forward(self, input_ids, token_type_ids, attention_mask, labels=None, n_class=1):
-        seq_length = input_ids.size(2)
-        _, pooled_output = self.bert(input_ids.view(-1,seq_length),
-                                     token_type_ids.view(-1,seq_length),
-                                     attention_mask.view(-1,seq_length))
+    def forward(self, input_ids, token_type_ids, attention_mask, labels=None, n_class=1,
+                position_ids=None, cls_index=None):
+        seq_length = input_ids.size(-1)
+        if cls_index is not None:
+            if self.shared_doc_layers > 0:
+                raise ValueError("Packed sequences cannot be combined with shared_doc_layers.")
+            pooled_output = self._packed_pooled_output(input_ids, token_type_ids, attention_mask,
+                                                       position_ids, cls_index)
+        elif self.shared_doc_layers > 0:
+            pooled_output = self._shared_document_pooled_output(input_ids, token_type_ids, attention_mask)
+        else:
+            _, pooled_output = self.bert(input_ids.view(-1,seq_length),
+                                         token_type_ids.view(-1,seq_length),
+                                         attention_mask.view(-1,seq_length),
+                                         output_layers="pooled")
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
-        logits = logits.view(-1, n_class)
+        logits = logits.view(-1, n_class).float()
 
         if labels is not None:
             loss_fct = CrossEntropyLoss()
@@ -415,6 +611,62 @@ class BertForSequenceClassification(nn.Module):
         else:
             return logits
 
+    def _packed_pooled_output(self, input_ids, token_type_ids, sequence_ids, position_ids, cls_index):
+        bert = self.bert
+        encoder_layers, _ = bert(input_ids, token_type_ids, packed_attention_mask(sequence_ids),
+                                 output_layers="last", position_ids=position_ids)
+        hidden_states = encoder_layers[-1]
+        cls_hidden = hidden_states.reshape(-1, hidden_states.size(-1))[cls_index]
+        return bert.pooler(cls_hidden.unsqueeze(1))
+
+    def _shared_document_pooled_output(self, input_ids, token_type_ids, attention_mask):
+        batch_size, num_choices, seq_length = input_ids.size()
+        device = input_ids.device
+        mask = attention_mask > 0
+        doc_lengths = (mask & (token_type_ids == 0)).sum(-1)
+        suffix_lengths = (mask & (token_type_ids == 1)).sum(-1)
+
+        # Choices may have truncated the document differently; share the shortest
+        # copy so every (document, suffix) pair still fits in seq_length.
+        doc_length, doc_choice = doc_lengths.min(-1)
+        doc_width = int(doc_length.max())
+        doc_range = torch.arange(doc_width, dtype=torch.long, device=device)
+        doc_ids = input_ids[torch.arange(batch_size, device=device), doc_choice, :doc_width]
+        doc_mask = doc_range.unsqueeze(0) < doc_length.unsqueeze(1)
+        doc_ids = doc_ids * doc_mask.long()
+
+        # The suffix ([question] [SEP] [choice] [SEP]) follows each choice's own copy
+        # of the document, and is moved right after the shared copy.
+        suffix_width = max(int(suffix_lengths.max()), 1)
+        suffix_range = torch.arange(suffix_width, dtype=torch.long, device=device)
+        suffix_index = (doc_lengths.unsqueeze(-1) + suffix_range).clamp(max=seq_length - 1)
+        suffix_ids = input_ids.gather(2, suffix_index)
+        suffix_mask = suffix_range < suffix_lengths.unsqueeze(-1)
+        suffix_ids = (suffix_ids * suffix_mask.long()).view(-1, suffix_width)
+        suffix_position_ids = (doc_length.view(-1, 1, 1) + suffix_range).expand(
+            batch_size, num_choices, suffix_width).reshape(-1, suffix_width)
+        suffix_mask = suffix_mask.view(-1, suffix_width)
+
+        bert = self.bert
+        doc_hidden = bert.embeddings(doc_ids, torch.zeros_like(doc_ids))
+        doc_hidden = bert.encoder(doc_hidden, bert.get_extended_attention_mask(doc_mask),
+                                  end_layer=self.shared_doc_layers,
+                                  output_layers=[self.shared_doc_layers - 1])[-1]
+        suffix_hidden = bert.embeddings(suffix_ids, torch.ones_like(suffix_ids), suffix_position_ids)
+        suffix_hidden = bert.encoder(suffix_hidden, bert.get_extended_attention_mask(suffix_mask),
+                                     end_layer=self.shared_doc_layers,
+                                     output_layers=[self.shared_doc_layers - 1])[-1]
+
+        hidden_size = doc_hidden.size(-1)
+        doc_hidden = doc_hidden.unsqueeze(1).expand(-1, num_choices, -1, -1).reshape(-1, doc_width, hidden_size)
+        doc_mask = doc_mask.unsqueeze(1).expand(-1, num_choices, -1).reshape(-1, doc_width)
+        hidden_states = torch.cat([doc_hidden, suffix_hidden], dim=1)
+        joint_mask = torch.cat([doc_mask, suffix_mask], dim=1)
+        hidden_states = bert.encoder(hidden_states, bert.get_extended_attention_mask(joint_mask),
+                                     start_layer=self.shared_doc_layers,
+                                     output_layers=[len(bert.encoder.layer) - 1])[-1]
+        return bert.pooler(hidden_states)
+
 class AlbertForSequenceClassification(AlbertPreTrainedModel):
     """BERT model for classification.
     This module is composed of the BERT model with a linear layer on top of
@@ -511,7 +763,7 @@ class BertForQuestionAnswering(nn.Module): #FIXME (kai): not modified accordingl
         self.apply(init_weights)
 
     def forward(self, input_ids, token_type_ids, attention_mask, start_positions=None, end_positions=None):
-        all_encoder_layers, _ = self.bert(input_ids, token_type_ids, attention_mask)
+        all_encoder_layers, _ = self.bert(input_ids, token_type_ids, attention_mask, output_layers="last")
         sequence_output = all_encoder_layers[-1]
         logits = self.qa_outputs(sequence_output)
         start_logits, end_logits = logits.split(1, dim=-1)
@@ -43,6 +43,30 @@ SCHEDULES = {
 }
 
 
+class LRSchedule(object):
+    """Learning rate multipliers of a schedule in SCHEDULES, precomputed for every step.
+
+    Steps past t_total (or any step when t_total is -1, i.e. no schedule) are
+    computed on the fly.
+    """
+    def __init__(self, schedule='warmup_cosine', warmup=-1, t_total=-1):
+        if schedule not in SCHEDULES:
+            raise ValueError("Invalid schedule parameter: {}".format(schedule))
+        self.schedule_fct = SCHEDULES[schedule]
+        self.warmup = warmup
+        self.t_total = t_total
+        self.table = []
+        if t_total != -1:
+            self.table = [self.schedule_fct(step/t_total, warmup) for step in range(int(t_total) + 1)]
+
+    def __call__(self, step):
+        if self.t_total == -1:
+            return 1.0
+        if step < len(self.table):
+            return self.table[step]
+        return self.schedule_fct(step/self.t_total, self.warmup)
+
+
 class BERTAdam(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix (and no ).
     Params:
@@ -56,10 +80,17 @@ class BERTAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay_rate: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+        per_tensor_clip: Clip every gradient tensor to max_grad_norm on its own, as earlier
+            versions did, instead of clipping by the global norm of all gradients. Default: False
+        foreach: Update all the parameters of a group with multi-tensor (torch._foreach_*)
+            kernels instead of one tensor at a time. Default: True when available
+        master_weights: Keep a float32 copy of every parameter that is not float32 (e.g. of
+            a model cast to bfloat16), update the copy and the moments in float32, and copy
+            the result back into the parameter. Default: False
     """
     def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_cosine',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay_rate=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, per_tensor_clip=False, foreach=None, master_weights=False):
         if not lr >= 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if schedule not in SCHEDULES:
@@ -72,25 +103,81 @@ class BERTAdam(Optimizer):
             raise ValueError("Invalid b2 parameter: {} - should be in [0.0, 1.0[".format(b2))
         if not e >= 0.0:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(e))
+        if foreach is None:
+            foreach = hasattr(torch, "_foreach_addcdiv_")
         defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total,
                         b1=b1, b2=b2, e=e, weight_decay_rate=weight_decay_rate,
-                        max_grad_norm=max_grad_norm)
+                        max_grad_norm=max_grad_norm, per_tensor_clip=per_tensor_clip)
         super(BERTAdam, self).__init__(params, defaults)
+        self.foreach = foreach
+        self.master_weights = master_weights
+        self._schedules = {}
 
-    def get_lr(self):
-        lr = []
+    def __setstate__(self, state):
+        super(BERTAdam, self).__setstate__(state)
+        # Checkpoints of earlier versions kept the step counter per parameter.
         for group in self.param_groups:
-            for p in group['params']:
-                state = self.state[p]
-                if len(state) == 0:
-                    return [0]
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
-                lr.append(lr_scheduled)
-        return lr
+            group.setdefault('per_tensor_clip', False)
+            if 'step' not in group:
+                group['step'] = max([self.state[p].pop('step', 0) for p in group['params']] or [0])
+
+    def load_state_dict(self, state_dict):
+        super(BERTAdam, self).load_state_dict(state_dict)
+        # Optimizer.load_state_dict casts the state to the dtype of its parameter,
+        # which would round the float32 master copies and their moments.
+        saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = [p for group in self.param_groups for p in group['params']]
+        for i, p in zip(saved_ids, params):
+            saved = state_dict['state'].get(i, {})
+            if 'master_param' in saved:
+                for key in ('master_param', 'next_m', 'next_v'):
+                    self.state[p][key] = saved[key].to(device=p.device, dtype=torch.float32)
+
+    def add_param_group(self, param_group):
+        param_group.setdefault('step', 0)
+        super(BERTAdam, self).add_param_group(param_group)
+
+    def _group_lr(self, group):
+        """Returns the scheduled learning rate of the next step of `group`."""
+        key = (group['schedule'], group['warmup'], group['t_total'])
+        if key not in self._schedules:
+            self._schedules[key] = LRSchedule(*key)
+        return group['lr'] * self._schedules[key](group['step'])
+
+    def get_lr(self):
+        """Returns the scheduled learning rate of every param group."""
+        return [self._group_lr(group) for group in self.param_groups]
+
+    def clip_grad_norm(self):
+        """Clips the gradients of every group by the global norm of all of them.
+
+        The norm is computed once over the parameters of the groups that clip, and
+        each group is then scaled against its own max_grad_norm.
+        """
+        clipped_groups = [group for group in self.param_groups
+                          if group['max_grad_norm'] > 0 and not group['per_tensor_clip']]
+        params = [p for group in clipped_groups for p in group['params'] if p.grad is not None]
+        if not params:
+            return None
+        # Only the norm is needed here; the gradients are scaled once, below, when they exceed it.
+        grads = [p.grad.data for p in params]
+        if self.foreach and hasattr(torch, "_foreach_norm"):
+            norms = torch._foreach_norm(grads)
+        else:
+            norms = [grad.norm() for grad in grads]
+        device = norms[0].device
+        total_norm = float(torch.stack([norm.float().to(device) for norm in norms]).norm())
+        for group in clipped_groups:
+            clip_coef = group['max_grad_norm'] / (total_norm + 1e-6)
+            grads = [p.grad.data for p in group['params'] if p.grad is not None]
+            if clip_coef >= 1.0 or not grads:
+                continue
+            if self.foreach:
+                torch._foreach_mul_(grads, clip_coef)
+            else:
+                for grad in grads:
+                    grad.mul_(clip_coef)
+        return total_norm
 
     def step(self, closure=None):
         """Performs a single optimization step.
@@ -103,7 +190,13 @@ class BERTAdam(Optimizer):
         if closure is not None:
             loss = closure()
 
+        # Add grad clipping
+        self.clip_grad_norm()
+
         for group in self.param_groups:
+            lr_scheduled = self._group_lr(group)
+            params, grads, exp_avgs, exp_avg_sqs = [], [], [], []
+            model_params, master_params = [], []
             for p in group['params']:
                 if p.grad is None:
                     continue
@@ -115,48 +208,76 @@ class BERTAdam(Optimizer):
 
                 # State initialization
                 if len(state) == 0:
-                    state['step'] = 0
+                    if self.master_weights and p.dtype != torch.float32:
+                        state['master_param'] = p.data.float()
                     # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
+                    state['next_m'] = torch.zeros_like(state.get('master_param', p.data))
                     # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
+                    state['next_v'] = torch.zeros_like(state.get('master_param', p.data))
 
-                next_m, next_v = state['next_m'], state['next_v']
-                beta1, beta2 = group['b1'], group['b2']
-
-                # Add grad clipping
-                if group['max_grad_norm'] > 0:
+                if group['max_grad_norm'] > 0 and group['per_tensor_clip']:
                     clip_grad_norm_(p, group['max_grad_norm'])
 
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                next_m.mul_(beta1).add_(1 - beta1, grad)
-                next_v.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                update = next_m / (next_v.sqrt() + group['e'])
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want ot decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                if group['weight_decay_rate'] > 0.0:
-                    update += group['weight_decay_rate'] * p.data
-
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
+                if 'master_param' in state:
+                    model_params.append(p.data)
+                    master_params.append(state['master_param'])
+                    params.append(state['master_param'])
+                    grads.append(grad.float())
                 else:
-                    lr_scheduled = group['lr']
+                    params.append(p.data)
+                    grads.append(grad)
+                exp_avgs.append(state['next_m'])
+                exp_avg_sqs.append(state['next_v'])
+
+            if not params:
+                continue
+            if self.foreach:
+                self._multi_tensor_update(group, params, grads, exp_avgs, exp_avg_sqs, lr_scheduled)
+            else:
+                self._single_tensor_update(group, params, grads, exp_avgs, exp_avg_sqs, lr_scheduled)
+            for param, master_param in zip(model_params, master_params):
+                param.copy_(master_param)
+            group['step'] += 1
 
-                update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
+        return loss
 
-                state['step'] += 1
+    def _single_tensor_update(self, group, params, grads, exp_avgs, exp_avg_sqs, lr_scheduled):
+        beta1, beta2 = group['b1'], group['b2']
+        for param, grad, next_m, next_v in zip(params, grads, exp_avgs, exp_avg_sqs):
+            # Decay the first and second moment running average coefficient
+            # In-place operations to update the averages at the same time
+            next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+            next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            update = next_m / (next_v.sqrt() + group['e'])
 
-                # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
-                # bias_correction1 = 1 - beta1 ** state['step']
-                # bias_correction2 = 1 - beta2 ** state['step']
+            # Just adding the square of the weights to the loss function is *not*
+            # the correct way of using L2 regularization/weight decay with Adam,
+            # since that will interact with the m and v parameters in strange ways.
+            #
+            # Instead we want ot decay the weights in a manner that doesn't interact
+            # with the m/v parameters. This is equivalent to adding the square
+            # of the weights to the loss with plain (non-momentum) SGD.
+            if group['weight_decay_rate'] > 0.0:
+                update += group['weight_decay_rate'] * param
 
-        return loss
+            update_with_lr = lr_scheduled * update
+            param.add_(-update_with_lr)
+
+            # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
+            # bias_correction1 = 1 - beta1 ** state['step']
+            # bias_correction2 = 1 - beta2 ** state['step']
+
+    def _multi_tensor_update(self, group, params, grads, exp_avgs, exp_avg_sqs, lr_scheduled):
+        beta1, beta2 = group['b1'], group['b2']
+        torch._foreach_mul_(exp_avgs, beta1)
+        torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+        torch._foreach_mul_(exp_avg_sqs, beta2)
+        torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+        # p -= lr * (m / (sqrt(v) + e) + weight_decay_rate * p), split into a decay of
+        # p followed by a fused addcdiv so only the denominator is allocated.
+        denom = torch._foreach_sqrt(exp_avg_sqs)
+        torch._foreach_add_(denom, group['e'])
+        if group['weight_decay_rate'] > 0.0:
+            torch._foreach_mul_(params, 1.0 - lr_scheduled * group['weight_decay_rate'])
+        torch._foreach_addcdiv_(params, exp_avgs, denom, value=-lr_scheduled)
@@ -18,26 +18,32 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
 import csv
+import itertools
 import os
 import logging
 import argparse
+import functools
 import random
 from tqdm import tqdm, trange
 
 import numpy as np
 import torch
-from torch.utils.data import TensorDataset, DataLoader, RandomSampler, SequentialSampler
+from torch.utils.data import DataLoader, RandomSampler, SequentialSampler, ConcatDataset
+from torch.utils.data import SubsetRandomSampler
 from torch.utils.data.distributed import DistributedSampler
 from torch.optim.lr_scheduler import CosineAnnealingLR
 
 import tokenization
+import feature_store
+import curriculum
+import modeling
 from modeling import BertConfig, BertForSequenceClassification
 from optimization import BERTAdam
 
 import json
 import time
-from sklearn.metrics import f1_score,precision_score,recall_score
 from collections import Counter
 from transformers import AutoConfig, AutoTokenizer
 from modeling import AlbertForSequenceClassification
@@ -46,13 +52,6 @@ n_class = 4
 reverse_order = False
 sa_step = False
 
-logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',datefmt = '%m/%d/%Y %H:%M:%S',
-                    filename='bert_empirical_CL.log',filemode='w',
-                    level = logging.INFO)
-
-console=logging.StreamHandler()
-console.setLevel(logging.INFO)
-logging.getLogger('').addHandler(console)
 logger = logging.getLogger(__name__)
 
 
@@ -115,63 +114,89 @@ class DataProcessor(object):
 
 
 class c3Processor(DataProcessor):
-    def __init__(self):
-        random.seed(42)
-        self.D = [[], [], []]
-        self.B = [[],[],[],[],[],[]]
+    """Reads the C3 JSON files of a split only when that split is requested.
+
+    Train and bucket questions are shuffled with a fixed seed of their own, so a
+    split comes out in the same order whichever splits were read before it.
+    """
 
+    def __init__(self, data_dir="../data"):
+        self.data_dir = data_dir
+        self.source_files = {}
         for sid in range(6):
-            with open("../data/c3-train-sort-f"+str(sid+1)+".json", "r", encoding="utf8") as f:
-                data = json.load(f)
-            random.shuffle(data)
-            for i in range(len(data)):
-                for j in range(len(data[i][1])):
-                    d = ['\n'.join(data[i][0]).lower(), data[i][1][j]["question"].lower()]
-                    for k in range(len(data[i][1][j]["choice"])):
-                        d += [data[i][1][j]["choice"][k].lower()]
-                    for k in range(len(data[i][1][j]["choice"]), 4):
-                        d += ['']
-                    d += [data[i][1][j]["answer"].lower()]
-                    self.B[sid] += [d]
-
-
-        for sid in range(3):
-            data = []
-            for subtask in ["d", "m"]:
-                with open("../data/c3-"+subtask+"-"+["train.json", "dev.json", "test.json"][sid], "r", encoding="utf8") as f:
-                    data += json.load(f)
-
-            if sid == 0:
-                random.shuffle(data)
-
-            for i in range(len(data)):
-                for j in range(len(data[i][1])):
-                    d = ['\n'.join(data[i][0]).lower(), data[i][1][j]["question"].lower()]
-                    for k in range(len(data[i][1][j]["choice"])):
-                        d += [data[i][1][j]["choice"][k].lower()]
-                    for k in range(len(data[i][1][j]["choice"]), 4):
-                        d += ['']
-                    d += [data[i][1][j]["answer"].lower()] 
-                    self.D[sid] += [d]
-    
+            self.source_files["bucket"+str(sid)] = [
+                os.path.join(data_dir, "c3-train-sort-f"+str(sid+1)+".json")]
+        for split in ["train", "dev", "test"]:
+            self.source_files[split] = [
+                os.path.join(data_dir, "c3-"+subtask+"-"+split+".json") for subtask in ["d", "m"]]
+
+    def _read_documents(self, split):
+        data = []
+        for path in self.source_files[split]:
+            with open(path, "r", encoding="utf8") as f:
+                data += json.load(f)
+        if split == "train" or split.startswith("bucket"):
+            random.Random(42).shuffle(data)
+        return data
+
+    def iter_questions(self, split):
+        """Yields the questions of `split` as [document, question, choice_0..choice_3, answer]."""
+        return self._iter_questions(self._read_documents(split))
+
+    def _iter_questions(self, documents):
+        for document in documents:
+            for question in document[1]:
+                d = ['\n'.join(document[0]).lower(), question["question"].lower()]
+                for k in range(len(question["choice"])):
+                    d += [question["choice"][k].lower()]
+                for k in range(len(question["choice"]), 4):
+                    d += ['']
+                d += [question["answer"].lower()]
+                yield d
+
+    def num_questions(self, split):
+        """Counts the questions of `split` without building any examples.
+
+        To read the examples as well, use `read_examples`, which parses the files only once.
+        """
+        num_questions = 0
+        for path in self.source_files[split]:
+            with open(path, "r", encoding="utf8") as f:
+                num_questions += sum(len(document[1]) for document in json.load(f))
+        return num_questions
+
     def get_train_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(
-            self.D[0], "train")
+        return self.get_examples(data_dir, "train")
 
     def get_test_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(
-                self.D[2], "test")
+        return self.get_examples(data_dir, "test")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
-        return self._create_examples(
-                self.D[1], "dev")
+        return self.get_examples(data_dir, "dev")
 
     def get_bucket_examples(self,data_dir,num):
-        return self._create_examples(
-            self.B[num],"bucket"+str(num))
+        return self.get_examples(data_dir, "bucket"+str(num))
+
+    def get_examples(self, data_dir, split):
+        """Gets the examples of `split`: train, dev, test or bucket0-bucket5."""
+        return list(self.iter_examples(split))
+
+    def iter_examples(self, split):
+        """Yields the examples of `split` one question (`n_class` examples) at a time."""
+        return self._create_examples(self.iter_questions(split), split)
+
+    def read_examples(self, split):
+        """Reads the JSON files of `split` once; returns its number of questions and an `iter_examples` iterator."""
+        documents = self._read_documents(split)
+        num_questions = sum(len(document[1]) for document in documents)
+        return num_questions, self._create_examples(self._iter_questions(documents), split)
+
+    def get_source_files(self, split):
+        """Gets the JSON files the examples of `split` are read from."""
+        return self.source_files[split]
 
     def get_labels(self):
         """See base class."""
@@ -179,104 +204,120 @@ class c3Processor(DataProcessor):
 
     def _create_examples(self, data, set_type):
         """Creates examples for the training and dev sets."""
-        examples = []
         for (i, d) in enumerate(data):
             for k in range(4):
-                if data[i][2+k] == data[i][6]:
+                if d[2+k] == d[6]:
                     answer = str(k)
                     
             label = tokenization.convert_to_unicode(answer)
 
             for k in range(4):
                 guid = "%s-%s-%s" % (set_type, i, k)
-                text_a = tokenization.convert_to_unicode(data[i][0])
-                text_b = tokenization.convert_to_unicode(data[i][k+2])
-                text_c = tokenization.convert_to_unicode(data[i][1])
-                examples.append(
-                        InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label, text_c=text_c))
-            
-        return examples
+                text_a = tokenization.convert_to_unicode(d[0])
+                text_b = tokenization.convert_to_unicode(d[k+2])
+                text_c = tokenization.convert_to_unicode(d[1])
+                yield InputExample(guid=guid, text_a=text_a, text_b=text_b, label=label, text_c=text_c)
 
 
-def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
-    """Loads a data file into a list of `InputBatch`s."""
+def iter_features(examples, label_list, max_seq_length, tokenizer, num_workers=1, block_questions=1024):
+    """Yields the features of `examples` one question (a list of `n_class` features) at a time.
 
-    print("#examples", len(examples))
+    `examples` may be any iterable of examples in groups of `n_class` choices of
+    one question, all sharing the same document and question. They are consumed
+    `block_questions` questions at a time; every distinct text of a block is
+    encoded only once, across `num_workers` processes, and its ids are reused by
+    the other choices and by later questions on the same document. The worker
+    processes are started once and serve every block.
+    """
 
     label_map = {}
     for (i, label) in enumerate(label_list):
         label_map[label] = i
 
-    features = [[]]
-    for (ex_index, example) in enumerate(examples):
-        tokens_a = tokenizer.tokenize(example.text_a)
-
-        tokens_b = tokenizer.tokenize(example.text_b)
-
-        tokens_c = tokenizer.tokenize(example.text_c)
-
-        _truncate_seq_tuple(tokens_a, tokens_b, tokens_c, max_seq_length - 4)
+    cls_id, sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+
+    pool = None
+    if num_workers is None or num_workers > 1:
+        pool = tokenizer.worker_pool(num_workers)
+    try:
+        examples = iter(examples)
+        ex_index = 0
+        while True:
+            block = list(itertools.islice(examples, block_questions * n_class))
+            if not block:
+                break
+            texts = list(collections.OrderedDict.fromkeys(
+                text for example in block for text in (example.text_a, example.text_b, example.text_c)))
+            token_cache = dict(zip(texts, tokenizer.encode_batch(texts, num_workers=1, pool=pool)))
+
+            question = []
+            for example in block:
+                question.append(_example_to_features(example, ex_index, label_map, max_seq_length, tokenizer,
+                                                     token_cache, cls_id, sep_id))
+                ex_index += 1
+                if len(question) == n_class:
+                    yield question
+                    question = []
+            if question:
+                yield question
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def _example_to_features(example, ex_index, label_map, max_seq_length, tokenizer, token_cache, cls_id, sep_id):
+    """Converts one example to `InputFeatures`, looking its texts up in `token_cache`."""
+
+    def encode(text):
+        # _truncate_seq_tuple pops in place, so hand out a copy.
+        return list(token_cache[text])
+
+    ids_a = encode(example.text_a)
+
+    ids_b = encode(example.text_b)
+
+    ids_c = encode(example.text_c)
+
+    _truncate_seq_tuple(ids_a, ids_b, ids_c, max_seq_length - 4)
+
+    ids_b = ids_c + [sep_id] + ids_b
+
+    #tokens=CLS 文档 SEP 问题 SEP 选项
+    input_ids = [cls_id] + ids_a + [sep_id] + ids_b + [sep_id]
+    segment_ids = [0] * (len(ids_a) + 2) + [1] * (len(ids_b) + 1)
+
+    # The mask has 1 for real tokens and 0 for padding tokens. Only real
+    # tokens are attended to.
+    input_mask = [1] * len(input_ids)
+
+    # Zero-pad up to the sequence length.
+    while len(input_ids) < max_seq_length:
+        input_ids.append(0)
+        input_mask.append(0)
+        segment_ids.append(0)
 
-        tokens_b = tokens_c + ["[SEP]"] + tokens_b
+    assert len(input_ids) == max_seq_length
+    assert len(input_mask) == max_seq_length
+    assert len(segment_ids) == max_seq_length
 
-        tokens = []
-        segment_ids = []
-        tokens.append("[CLS]")
-        segment_ids.append(0)
-        for token in tokens_a:
-            tokens.append(token)
-            segment_ids.append(0)
-        tokens.append("[SEP]")
-        segment_ids.append(0)
+    label_id = label_map[example.label]
+    if ex_index < 5:
+        logger.info("*** Example ***")
+        logger.info("guid: %s" % (example.guid))
+        logger.info("tokens: %s" % " ".join(
+                [tokenization.printable_text(x) for x in tokenizer.convert_ids_to_tokens(input_ids)]))
+        logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
+        logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
+        logger.info(
+                "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
+        logger.info("label: %s (id = %d)" % (example.label, label_id))
 
-        if tokens_b:
-            for token in tokens_b:
-                tokens.append(token)
-                segment_ids.append(1)
-            tokens.append("[SEP]")
-            segment_ids.append(1)
-
-        input_ids = tokenizer.convert_tokens_to_ids(tokens)   #tokens=CLS 文档 SEP 问题 SEP 选项
-
-        # The mask has 1 for real tokens and 0 for padding tokens. Only real
-        # tokens are attended to.
-        input_mask = [1] * len(input_ids)
-
-        # Zero-pad up to the sequence length.
-        while len(input_ids) < max_seq_length:
-            input_ids.append(0)
-            input_mask.append(0)
-            segment_ids.append(0)
-
-        assert len(input_ids) == max_seq_length
-        assert len(input_mask) == max_seq_length
-        assert len(segment_ids) == max_seq_length
-
-        label_id = label_map[example.label]
-        if ex_index < 5:
-            logger.info("*** Example ***")
-            logger.info("guid: %s" % (example.guid))
-            logger.info("tokens: %s" % " ".join(
-                    [tokenization.printable_text(x) for x in tokens]))
-            logger.info("input_ids: %s" % " ".join([str(x) for x in input_ids]))
-            logger.info("input_mask: %s" % " ".join([str(x) for x in input_mask]))
-            logger.info(
-                    "segment_ids: %s" % " ".join([str(x) for x in segment_ids]))
-            logger.info("label: %s (id = %d)" % (example.label, label_id))
-
-        features[-1].append(
-                InputFeatures(
-                        input_ids=input_ids,
-                        input_mask=input_mask,
-                        segment_ids=segment_ids,
-                        label_id=label_id))
-        if len(features[-1]) == n_class:
-            features.append([])
-
-    if len(features[-1]) == 0:
-        features = features[:-1]
-    print('#features', len(features))
-    return features
+    return InputFeatures(
+            input_ids=input_ids,
+            input_mask=input_mask,
+            segment_ids=segment_ids,
+            label_id=label_id)
 
 
 
@@ -304,56 +345,192 @@ def accuracy(out, labels):
     return np.sum(outputs==labels)
 
 def F1(labels,logits_all):
-    outputs=np.argmax(logits_all,axis=1)
-    return f1_score(labels,outputs,average="macro")
+    return precision_recall_f1(labels, logits_all)[2]
+
+def confusion_matrix(labels, outputs, num_labels):
+    """Counts (label, prediction) pairs into a [num_labels, num_labels] matrix."""
+    labels = np.asarray(labels).reshape(-1)
+    outputs = np.asarray(outputs).reshape(-1)
+    return np.bincount(labels * num_labels + outputs, minlength=num_labels * num_labels).reshape(
+        num_labels, num_labels)
+
+def macro_precision_recall_f1(confusion):
+    """Macro-averaged (p, r, f1) from a confusion matrix with labels on the rows.
+
+    As in sklearn's average="macro", the average runs over the labels that occur
+    as a label or a prediction, and a label without predictions (or without
+    examples) has a precision (or recall) of 0.
+    """
+    tp = np.diag(confusion).astype(np.float64)
+    predicted = confusion.sum(0)
+    actual = confusion.sum(1)
+    present = (predicted + actual) > 0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(predicted > 0, tp / predicted, 0.0)
+        r = np.where(actual > 0, tp / actual, 0.0)
+        f1 = np.where(predicted + actual > 0, 2 * tp / (predicted + actual), 0.0)
+    return p[present].mean(), r[present].mean(), f1[present].mean()
 
 def precision_recall_f1(labels,logits_all):
     """
     This function calculates and returns the precision, recall and f1-score
     Args:
-        prediction: prediction string or list to be matched,一篇文档分好词的
-        ground_truth: golden string or list reference
+        labels: gold label ids
+        logits_all: [num_examples, num_labels] logits
     Returns:
         floats of (p, r, f1)
     Raises:
         None
     """
 
+    logits_all = np.asarray(logits_all)
     outputs = np.argmax(logits_all, axis=1)
-    p = precision_score(labels, outputs, average="macro")
-    r = recall_score(labels, outputs, average="macro")
-    f1 = f1_score(labels, outputs, average="macro")
-    return p, r, f1
-
-def feature2dataloader(bucket_features,batch_size):
-    input_ids = []
-    input_mask = []
-    segment_ids = []
-    label_id = []
-    for f in bucket_features:
-        input_ids.append([])
-        input_mask.append([])
-        segment_ids.append([])
-        for i in range(n_class):
-            input_ids[-1].append(f[i].input_ids)
-            input_mask[-1].append(f[i].input_mask)
-            segment_ids[-1].append(f[i].segment_ids)
-        label_id.append([f[0].label_id])
-
-    all_input_ids = torch.tensor(input_ids, dtype=torch.long)
-    all_input_mask = torch.tensor(input_mask, dtype=torch.long)
-    all_segment_ids = torch.tensor(segment_ids, dtype=torch.long)
-    all_label_ids = torch.tensor(label_id, dtype=torch.long)
-
-    bucket_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-
-    bucket_sampler = RandomSampler(bucket_data)
+    return macro_precision_recall_f1(confusion_matrix(labels, outputs, logits_all.shape[1]))
+
+
+EvalResult = collections.namedtuple(
+    "EvalResult", ["loss", "accuracy", "precision", "recall", "f1", "logits", "labels"])
+
+
+def evaluate(model, eval_dataloader, device, num_labels=n_class, precision="fp32"):
+    """Runs `model` over `eval_dataloader` once and scores its predictions.
+
+    Logits are copied into a buffer preallocated for every question of the
+    loader, and accuracy and macro P/R/F1 come from one confusion matrix.
+    `loss` is the mean of the per-batch losses. The forward pass runs at
+    `precision` (see `modeling.autocast`).
+
+    Returns:
+        An `EvalResult`; `logits` is a [num_questions, num_labels] float32 array
+        and `labels` the matching label ids.
+    """
+    num_questions = len(eval_dataloader.sampler)
+    logits_all = torch.empty(num_questions, num_labels, dtype=torch.float32)
+    labels_all = torch.empty(num_questions, dtype=torch.long)
+    loss_sum = torch.zeros((), dtype=torch.float64, device=device)
+    nb_eval_steps, offset = 0, 0
+
+    model.eval()
+    with inference_mode():
+        for input_ids, input_mask, segment_ids, label_ids in eval_dataloader:
+            input_ids = input_ids.to(device).long()
+            input_mask = input_mask.to(device).long()
+            segment_ids = segment_ids.to(device).long()
+            label_ids = label_ids.to(device).long()
+
+            with modeling.autocast(device, precision):
+                tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, n_class)
+
+            batch_size = logits.size(0)
+            logits_all[offset:offset + batch_size] = logits.float()
+            labels_all[offset:offset + batch_size] = label_ids.view(-1)
+            loss_sum += tmp_eval_loss.mean().double()
+            offset += batch_size
+            nb_eval_steps += 1
+
+    logits_all = logits_all[:offset].numpy()
+    labels_all = labels_all[:offset].numpy()
+    confusion = confusion_matrix(labels_all, np.argmax(logits_all, axis=1), num_labels)
+    pre, rec, f1 = macro_precision_recall_f1(confusion)
+    return EvalResult(loss=loss_sum.item() / max(nb_eval_steps, 1),
+                      accuracy=np.trace(confusion) / max(offset, 1),
+                      precision=pre, recall=rec, f1=f1,
+                      logits=logits_all, labels=labels_all)
+
+
+def inference_mode():
+    """`torch.inference_mode()` where available, `torch.no_grad()` on older PyTorch."""
+    if hasattr(torch, "inference_mode"):
+        return torch.inference_mode()
+    return torch.no_grad()
+
+
+def eval_result_dict(result, train_state=None):
+    """The metrics logged and written for an `EvalResult`, plus `train_state` when training."""
+    output = {'eval_loss': result.loss,
+              'eval_accuracy': result.accuracy,
+              'f1': result.f1,
+              'pre': result.precision,
+              'rec': result.recall}
+    if train_state is not None:
+        output.update(train_state)
+    return output
+
+
+def write_eval_results(output_dir, split, result, train_state=None):
+    """Logs `result` and writes eval_results_<split>.txt and logits_<split>.txt to `output_dir`."""
+    output = eval_result_dict(result, train_state)
+    output_eval_file = os.path.join(output_dir, "eval_results_%s.txt" % split)
+    with open(output_eval_file, "w") as writer:
+        logger.info("***** Eval results *****")
+        for key in sorted(output.keys()):
+            logger.info("  %s = %s", key, str(output[key]))
+            writer.write("%s = %s\n" % (key, str(output[key])))
+    output_eval_file = os.path.join(output_dir, "logits_%s.txt" % split)
+    with open(output_eval_file, "w") as f:
+        for row in result.logits:
+            f.write(" ".join(str(x) for x in row) + "\n")
+
+def load_features(processor, split, label_list, tokenizer, args):
+    """Returns the features of `split` as a `FeatureArrayDataset`.
+
+    Features are memory-mapped from `args.cache_dir` when a matching entry exists,
+    otherwise they are built from the examples and written to the cache.
+    """
+    key = None
+    if not args.no_feature_cache:
+        key = feature_store.feature_cache_key(args.vocab_file, args.max_seq_length, args.do_lower_case,
+                                              processor.get_source_files(split), split)
+        arrays = feature_store.load_feature_arrays(args.cache_dir, key)
+        if arrays is not None:
+            logger.info("Loaded cached %s features from %s", split, os.path.join(args.cache_dir, key))
+            return feature_store.FeatureArrayDataset(arrays, path=os.path.join(args.cache_dir, key))
+
+    num_questions, examples = processor.read_examples(split)
+    features = iter_features(examples, label_list, args.max_seq_length, tokenizer,
+                             num_workers=args.preprocess_workers)
+    arrays = feature_store.features_to_arrays(features, n_class, num_questions=num_questions,
+                                              seq_length=args.max_seq_length, vocab_size=len(tokenizer.vocab))
+    if key is None:
+        return feature_store.FeatureArrayDataset(arrays)
+    feature_store.save_feature_arrays(args.cache_dir, key, arrays)
+    # Serve the written entry, so the built arrays can be freed and workers share the files.
+    return feature_store.FeatureArrayDataset(path=os.path.join(args.cache_dir, key))
+
+def feature2dataloader(bucket_data,batch_size,indices=None,lengths=None,num_workers=0,pack_length=None):
+    """Samples batches from the rows `indices` of `bucket_data` (all rows by default).
+
+    Passing the per-question `lengths` of `bucket_data` batches questions of
+    similar length together. Passing `pack_length` packs the choice sequences of
+    every batch into rows of that many tokens (see `feature_store.pack_collate`).
+    """
+    collate_fn = feature_store.trim_collate
+    if pack_length is not None:
+        collate_fn = functools.partial(feature_store.pack_collate, pack_length=pack_length)
+    if lengths is not None:
+        # The length-grouped sampler yields whole batches.
+        batch_sampler = feature_store.LengthGroupedSampler(lengths, batch_size, indices)
+        return DataLoader(bucket_data, batch_sampler=batch_sampler, collate_fn=collate_fn, num_workers=num_workers)
+    elif indices is not None:
+        bucket_sampler = SubsetRandomSampler(indices)
+    else:
+        bucket_sampler = RandomSampler(bucket_data)
     # train_sampler = SequentialSampler(train_data)
 
-    bucket_dataloader = DataLoader(bucket_data, sampler=bucket_sampler, batch_size=batch_size)
+    bucket_dataloader = DataLoader(bucket_data, sampler=bucket_sampler, batch_size=batch_size,
+                                   collate_fn=collate_fn, num_workers=num_workers)
     return bucket_dataloader
 
 def main():
+    # Set up here rather than on import, so that importing this module does not truncate the log.
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',datefmt = '%m/%d/%Y %H:%M:%S',
+                        filename='bert_empirical_CL.log',filemode='w',
+                        level = logging.INFO)
+
+    console=logging.StreamHandler()
+    console.setLevel(logging.INFO)
+    logging.getLogger('').addHandler(console)
+
     parser = argparse.ArgumentParser()
 
     ## Required parameters
@@ -438,6 +615,10 @@ def main():
                         type=float,
                         help="Proportion of training to perform linear learning rate warmup for. "
                              "E.g., 0.1 = 10%% of training.")
+    parser.add_argument("--per_tensor_clip",
+                        default=False,
+                        action='store_true',
+                        help="Whether to clip every gradient tensor on its own instead of by the global norm.")
     parser.add_argument("--save_checkpoints_steps",
                         default=1000,
                         type=int,
@@ -462,8 +643,101 @@ def main():
                         default=8,
                         type=int,
                         help="Total batch size for eval.")
+    parser.add_argument("--cache_dir",
+                        default=None,
+                        type=str,
+                        help="Where to cache tokenized features. Defaults to <data_dir>/cache.")
+    parser.add_argument("--curriculum",
+                        default="baby_step",
+                        choices=curriculum.CURRICULA,
+                        help="How the difficulty buckets are scheduled over the training epochs.")
+    parser.add_argument("--curriculum_epochs",
+                        default=13,
+                        type=int,
+                        help="Number of epochs to train over the curriculum buckets.")
+    parser.add_argument("--epochs_per_stage",
+                        default=2,
+                        type=int,
+                        help="Epochs spent on each stage of the baby_step, oscillate and annealing curricula.")
+    parser.add_argument("--competence_c0",
+                        default=0.01,
+                        type=float,
+                        help="Initial competence of the competence_* curricula.")
+    parser.add_argument("--competence_epochs",
+                        default=None,
+                        type=int,
+                        help="Epochs until the competence_* curricula reach all buckets. "
+                             "Defaults to epochs_per_stage times the number of buckets.")
+    parser.add_argument("--group_by_length",
+                        default=False,
+                        action='store_true',
+                        help="Whether to batch training questions of similar length together.")
+    parser.add_argument("--shared_doc_layers",
+                        default=0,
+                        type=int,
+                        help="Number of lower encoder layers in which the document is encoded once per question, "
+                             "separately from the question and choices. 0 encodes every choice in full.")
+    parser.add_argument("--no_feature_cache",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to read or write the on-disk feature cache.")
+    parser.add_argument("--num_workers",
+                        default=0,
+                        type=int,
+                        help="Number of DataLoader worker processes reading the cached features.")
+    parser.add_argument("--preprocess_workers",
+                        default=1,
+                        type=int,
+                        help="Number of processes that tokenize the data when features are built. "
+                             "0 uses every CPU.")
+    parser.add_argument("--tensorboard_dir",
+                        default=None,
+                        type=str,
+                        help="Where to write TensorBoard scalars of the learning rate and loss of every update step.")
+    parser.add_argument("--precision",
+                        default="fp32",
+                        choices=modeling.PRECISIONS,
+                        help="fp32; bf16 to run the model under bfloat16 autocast with float32 weights; or "
+                             "pure_bf16 to also keep the weights in bfloat16, with float32 master weights "
+                             "in the optimizer.")
+    parser.add_argument("--attention_backend",
+                        default=None,
+                        choices=modeling.ATTENTION_BACKENDS,
+                        help="Overrides the attention_backend of the BERT config: eager, or sdpa for "
+                             "PyTorch's fused scaled_dot_product_attention.")
+    parser.add_argument("--checkpoint_every",
+                        default=0,
+                        type=int,
+                        help="Recompute the activations of every k-th encoder layer in the backward pass "
+                             "instead of keeping them (1 checkpoints every layer, 0 none), to fit larger "
+                             "micro-batches.")
+    parser.add_argument("--checkpoint_memory_mb",
+                        default=None,
+                        type=float,
+                        help="Instead of --checkpoint_every, checkpoint only the encoder layers whose "
+                             "activations would not fit in this many MB per micro-batch.")
+    parser.add_argument("--pack_sequences",
+                        default=False,
+                        action='store_true',
+                        help="Whether to pack the (document, question, choice) sequences of each training "
+                             "batch into rows of --pack_length tokens with block-diagonal attention, "
+                             "instead of padding every sequence to the longest one.")
+    parser.add_argument("--pack_length",
+                        default=None,
+                        type=int,
+                        help="Length of the packed rows. Defaults to max_seq_length.")
 
     args = parser.parse_args()
+    if args.cache_dir is None:
+        args.cache_dir = os.path.join(args.data_dir, "cache")
+    if args.preprocess_workers < 1:
+        args.preprocess_workers = None
+    if args.pack_length is None:
+        args.pack_length = args.max_seq_length
+    if args.pack_sequences and args.shared_doc_layers > 0:
+        raise ValueError("--pack_sequences cannot be combined with --shared_doc_layers.")
+    if args.pack_sequences and args.pack_length < args.max_seq_length:
+        raise ValueError("--pack_length should be at least max_seq_length.")
     logger.info(args)
 
     processors = {
@@ -497,6 +771,8 @@ def main():
         raise ValueError("At least one of `do_train` or `do_eval` must be True.")
 
     bert_config = BertConfig.from_json_file(args.bert_config_file)
+    if args.attention_backend is not None:
+        bert_config.attention_backend = args.attention_backend
     # config = AutoConfig.from_pretrained(args.model_name_or_path)
 
     if args.max_seq_length > bert_config.max_position_embeddings:
@@ -515,28 +791,20 @@ def main():
     if task_name not in processors:
         raise ValueError("Task not found: %s" % (task_name))
 
-    processor = processors[task_name]()
+    processor = processors[task_name](args.data_dir)
     label_list = processor.get_labels()
 
     tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
     # tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
 
-    train_examples = None
     num_train_steps = None
     if args.do_train:
-        train_examples = processor.get_train_examples(args.data_dir)
         num_train_steps = int(
-            len(train_examples) / n_class / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
+            processor.num_questions("train") / args.train_batch_size / args.gradient_accumulation_steps * args.num_train_epochs)
 
-    if args.do_bucket:
-        bucket0_examples = processor.get_bucket_examples(args.data_dir, 0)
-        bucket1_examples = processor.get_bucket_examples(args.data_dir, 1)
-        bucket2_examples = processor.get_bucket_examples(args.data_dir, 2)
-        bucket3_examples = processor.get_bucket_examples(args.data_dir, 3)
-        bucket4_examples = processor.get_bucket_examples(args.data_dir, 4)
-        bucket5_examples = processor.get_bucket_examples(args.data_dir, 5)
-
-    model = BertForSequenceClassification(bert_config, 1 if n_class > 1 else len(label_list))
+    model = BertForSequenceClassification(bert_config, 1 if n_class > 1 else len(label_list),
+                                          shared_doc_layers=args.shared_doc_layers)
+    model.bert.encoder.set_checkpointing(args.checkpoint_every, args.checkpoint_memory_mb)
     # model = AlbertForSequenceClassification.from_pretrained(args.model_name_or_path, 1, config=config)
 
     if args.init_checkpoint is not None:
@@ -562,12 +830,14 @@ def main():
         model.bert.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'))
         # checkpoint = torch.load(os.path.join(args.output_dir, "model_best.pt"),map_location='cpu')
         # model.load_state_dict(checkpoint['model'])
-    model.to(device)
+    model.to(device=device, dtype=modeling.parameter_dtype(args.precision))
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
                                                           output_device=args.local_rank)
     elif n_gpu > 1:
+        if args.pack_sequences:
+            raise ValueError("--pack_sequences does not support DataParallel; use one process per GPU.")
         model = torch.nn.DataParallel(model)
 
     no_decay = ['bias', 'gamma', 'beta']
@@ -579,119 +849,86 @@ def main():
     optimizer = BERTAdam(optimizer_parameters,
                          lr=args.learning_rate,
                          warmup=args.warmup_proportion,
-                         t_total=num_train_steps
+                         t_total=num_train_steps,
+                         per_tensor_clip=args.per_tensor_clip,
+                         master_weights=args.precision == "pure_bf16"
                          )
     # scheduler = CosineAnnealingLR(optimizer, T_max=1798,eta_min=0)
     # optimizer.load_state_dict(checkpoint['optimizer'])
 
     global_step = 0
+    tb_writer = None
+    if args.tensorboard_dir is not None:
+        try:
+            from torch.utils.tensorboard import SummaryWriter
+        except ImportError:
+            raise ImportError("--tensorboard_dir requires the tensorboard package.")
+        tb_writer = SummaryWriter(args.tensorboard_dir)
 
     if args.do_eval:
-        eval_examples = processor.get_dev_examples(args.data_dir)
-        eval_features = convert_examples_to_features(
-            eval_examples, label_list, args.max_seq_length, tokenizer)
-
-        input_ids = []
-        input_mask = []
-        segment_ids = []
-        label_id = []
-        
-        for f in eval_features:
-            input_ids.append([])
-            input_mask.append([])
-            segment_ids.append([])
-            for i in range(n_class):
-                input_ids[-1].append(f[i].input_ids)
-                input_mask[-1].append(f[i].input_mask)
-                segment_ids[-1].append(f[i].segment_ids)
-            label_id.append([f[0].label_id])                
-
-        all_input_ids = torch.tensor(input_ids, dtype=torch.long)
-        all_input_mask = torch.tensor(input_mask, dtype=torch.long)
-        all_segment_ids = torch.tensor(segment_ids, dtype=torch.long)
-        all_label_ids = torch.tensor(label_id, dtype=torch.long)
-
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        eval_data = load_features(processor, "dev", label_list, tokenizer, args)
         if args.local_rank == -1:
             eval_sampler = SequentialSampler(eval_data)
         else:
             eval_sampler = DistributedSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=feature_store.trim_collate, num_workers=args.num_workers)
 
     if args.do_bucket:
 
-        bucket0_features = convert_examples_to_features(bucket0_examples, label_list, args.max_seq_length, tokenizer)
-        bucket1_features = convert_examples_to_features(bucket1_examples, label_list, args.max_seq_length, tokenizer)
-        bucket2_features = convert_examples_to_features(bucket2_examples, label_list, args.max_seq_length, tokenizer)
-        bucket3_features = convert_examples_to_features(bucket3_examples, label_list, args.max_seq_length, tokenizer)
-        bucket4_features = convert_examples_to_features(bucket4_examples, label_list, args.max_seq_length, tokenizer)
-        bucket5_features = convert_examples_to_features(bucket5_examples, label_list, args.max_seq_length, tokenizer)
-
-        bucket1_features.extend(bucket0_features)
-        bucket2_features.extend(bucket1_features)
-        bucket3_features.extend(bucket2_features)
-        bucket4_features.extend(bucket3_features)
-        bucket5_features.extend(bucket4_features)
-
-        bucket0_dataloader = feature2dataloader(bucket0_features, args.train_batch_size)
-        bucket1_dataloader = feature2dataloader(bucket1_features, args.train_batch_size)
-        bucket2_dataloader = feature2dataloader(bucket2_features, args.train_batch_size)
-        bucket3_dataloader = feature2dataloader(bucket3_features, args.train_batch_size)
-        bucket4_dataloader = feature2dataloader(bucket4_features, args.train_batch_size)
-        bucket5_dataloader = feature2dataloader(bucket5_features, args.train_batch_size)
-
-        logger.info("len_bucket0_dataloader=%d" % len(bucket0_dataloader))
-        logger.info("len_bucket1_dataloader=%d" % len(bucket1_dataloader))
-        logger.info("len_bucket2_dataloader=%d" % len(bucket2_dataloader))
-        logger.info("len_bucket3_dataloader=%d" % len(bucket3_dataloader))
-        logger.info("len_bucket4_dataloader=%d" % len(bucket4_dataloader))
-        logger.info("len_bucket5_dataloader=%d" % len(bucket5_dataloader))
-
+        # Every bucket is stored once, easiest first; the curriculum scheduler picks
+        # the rows of the packed store to sample from in each epoch.
+        bucket_store = ConcatDataset([load_features(processor, "bucket%d" % i, label_list, tokenizer, args)
+                                      for i in range(6)])
+        bucket_lengths = feature_store.feature_lengths(bucket_store) if args.group_by_length else None
+        scheduler = curriculum.build_scheduler(args.curriculum, bucket_store.cumulative_sizes,
+                                               epochs_per_stage=args.epochs_per_stage,
+                                               competence_c0=args.competence_c0,
+                                               competence_epochs=args.competence_epochs,
+                                               seed=args.seed)
 
         logger.info("***** Running training with bucket*****")
+        logger.info("  Curriculum = %s", args.curriculum)
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_loaders = [bucket0_dataloader, bucket1_dataloader, bucket2_dataloader,
-                       bucket3_dataloader,
-                       bucket4_dataloader,
-                       bucket5_dataloader]
 
         best_accuracy = 0
-        increase=True
-        # j=-1
-        for _epoch in range(13):
-            j= _epoch //2   # j = _epoch
-            if j > 5:
-                j = 5
-            # if increase:
-            #     j += 1
-            #     if j == 5:
-            #         increase = False
-            #         # j=5
-            # else:
-            #     j -= 1
-            #     if j == 0:
-            #         increase = True
-            #         # j=0
+        for _epoch in range(args.curriculum_epochs):
+            epoch_indices = scheduler.epoch_indices(_epoch)
+            bucket_dataloader = feature2dataloader(bucket_store, args.train_batch_size, epoch_indices, bucket_lengths,
+                                                   num_workers=args.num_workers,
+                                                   pack_length=args.pack_length if args.pack_sequences else None)
+            logger.info("bucket_epoch=%d, questions=%d, len_bucket_dataloader=%d" % (
+                _epoch, len(epoch_indices), len(bucket_dataloader)))
 
             model.train()
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
             start_time = time.time()
             elapsed_time=0
-            for step, batch in enumerate(tqdm(all_loaders[j] , desc="bucket_Iteration")):
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
-                loss, _ = model(input_ids, segment_ids, input_mask, label_ids, n_class)
+            for step, batch in enumerate(tqdm(bucket_dataloader, desc="bucket_Iteration")):
+                # Features are stored narrow; widen them once they are on the device.
+                batch = tuple(t.to(device).long() for t in batch)
+                if args.pack_sequences:
+                    input_ids, input_mask, segment_ids, position_ids, cls_index, label_ids = batch
+                    packed = dict(position_ids=position_ids, cls_index=cls_index)
+                else:
+                    input_ids, input_mask, segment_ids, label_ids = batch
+                    packed = {}
+                with modeling.autocast(device, args.precision):
+                    loss, _ = model(input_ids, segment_ids, input_mask, label_ids, n_class, **packed)
                 if n_gpu > 1:
                     loss = loss.mean()  # mean() to average on multi-gpu.
                 if args.gradient_accumulation_steps > 1:
                     loss = loss / args.gradient_accumulation_steps
                 loss.backward()
                 tr_loss += loss.item()
-                nb_tr_examples += input_ids.size(0)
+                nb_tr_examples += label_ids.size(0)
                 nb_tr_steps += 1
                 if (step + 1) % args.gradient_accumulation_steps == 0:
+                    if tb_writer is not None:
+                        tb_writer.add_scalar("train/lr", optimizer.get_lr()[0], global_step)
+                        tb_writer.add_scalar("train/loss", loss.item() * args.gradient_accumulation_steps, global_step)
                     optimizer.step()  # We have accumulated enought gradients
                     model.zero_grad()
                     global_step += 1
@@ -707,52 +944,10 @@ def main():
             elapsed_time =( time.time() - start_time)
             logger.info("bucket_epoch=%d, elpased_time=%d(不包括验证时间)" % (_epoch, elapsed_time))
 
-            model.eval()
-            eval_loss, eval_accuracy = 0, 0
-            nb_eval_steps, nb_eval_examples = 0, 0
-            logits_all = []
-            label_ids_all = []
-            for input_ids, input_mask, segment_ids, label_ids in eval_dataloader:
-                input_ids = input_ids.to(device)
-                input_mask = input_mask.to(device)
-                segment_ids = segment_ids.to(device)
-                label_ids = label_ids.to(device)
-
-                with torch.no_grad():
-                    tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, n_class)
-
-                logits = logits.detach().cpu().numpy()
-                label_ids = label_ids.to('cpu').numpy()
-                for i in range(len(logits)):
-                    logits_all += [logits[i]]
-                for i in range(len(label_ids)):
-                    label_ids_all += [label_ids[i]]
-
-                tmp_eval_accuracy = accuracy(logits, label_ids.reshape(-1))
-
-                eval_loss += tmp_eval_loss.mean().item()
-                eval_accuracy += tmp_eval_accuracy
-
-                nb_eval_examples += input_ids.size(0)
-                nb_eval_steps += 1
-
-            eval_loss = eval_loss / nb_eval_steps
-            eval_accuracy = eval_accuracy / nb_eval_examples
-            pre, rec, f1 = precision_recall_f1(label_ids_all, logits_all)
-            if args.do_train:
-                result = {'eval_loss': eval_loss,
-                          'eval_accuracy': eval_accuracy,
-                          'global_step': global_step,
-                          'loss': tr_loss / nb_tr_steps,
-                          'f1': f1,
-                          'pre': pre,
-                          'rec': rec}
-            else:
-                result = {'eval_loss': eval_loss,
-                          'eval_accuracy': eval_accuracy,
-                          'f1': f1,
-                          'pre': pre,
-                          'rec': rec}
+            eval_result = evaluate(model, eval_dataloader, device, precision=args.precision)
+            eval_accuracy = eval_result.accuracy
+            train_state = {'global_step': global_step, 'loss': tr_loss / nb_tr_steps} if args.do_train else None
+            result = eval_result_dict(eval_result, train_state)
 
             logger.info("***** 第%d个epoch的第*个 Eval results *****" % (_epoch))
             for key in sorted(result.keys()):
@@ -764,7 +959,8 @@ def main():
                 best_accuracy = eval_accuracy
             # start_time = time.time()
 
-
+    if tb_writer is not None:
+        tb_writer.close()
 
     checkpoint = torch.load(os.path.join(args.output_dir, "model_best.pt"))
     model.load_state_dict(checkpoint['model'])
@@ -772,179 +968,35 @@ def main():
     epoch = checkpoint['epoch']
     # model.load_state_dict(torch.load(os.path.join(args.output_dir, "model.pt")))
 
+    train_state = None
+    if args.do_train and args.do_bucket:
+        train_state = {'global_step': global_step, 'loss': tr_loss/nb_tr_steps}
+
     if args.do_eval:
         #验证集dev.json
         logger.info("***** Running evaluation *****")
-        logger.info("  Num examples = %d", len(eval_examples))
+        logger.info("  Num examples = %d", len(eval_data) * n_class)
         logger.info("  Batch size = %d", args.eval_batch_size)
 
-        model.eval()
-        eval_loss, eval_accuracy = 0, 0
-        nb_eval_steps, nb_eval_examples = 0, 0
-        logits_all = []
-        label_ids_all=[]
-        for input_ids, input_mask, segment_ids, label_ids in eval_dataloader:
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
-
-            with torch.no_grad():
-                tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, n_class)
-
-            logits = logits.detach().cpu().numpy()
-            label_ids = label_ids.to('cpu').numpy()
-            for i in range(len(logits)):
-                logits_all += [logits[i]]
-
-            for i in range(len(label_ids)):
-                label_ids_all +=[label_ids[i]]
-
-            tmp_eval_accuracy = accuracy(logits, label_ids.reshape(-1))
-
-            eval_loss += tmp_eval_loss.mean().item()
-            eval_accuracy += tmp_eval_accuracy
-
-            nb_eval_examples += input_ids.size(0)
-            nb_eval_steps += 1
-
-        eval_loss = eval_loss / nb_eval_steps
-        eval_accuracy = eval_accuracy / nb_eval_examples
-
-        # f1=F1(label_ids_all,logits_all)
-        pre, rec, f1 = precision_recall_f1(label_ids_all, logits_all)
-        if args.do_train:
-            result = {'eval_loss': eval_loss,
-                      'eval_accuracy': eval_accuracy,
-                      'global_step': global_step,
-                      'loss': tr_loss/nb_tr_steps,
-                      'f1':f1,
-                      'pre':pre,
-                      'rec':rec}
-        else:
-            result = {'eval_loss': eval_loss,
-                      'eval_accuracy': eval_accuracy,
-                      'f1':f1,
-                      'pre':pre,
-                      'rec':rec}
-
-
-        output_eval_file = os.path.join(args.output_dir, "eval_results_dev.txt")
-        with open(output_eval_file, "w") as writer:
-            logger.info("***** Eval results *****")
-            for key in sorted(result.keys()):
-                logger.info("  %s = %s", key, str(result[key]))
-                writer.write("%s = %s\n" % (key, str(result[key])))
-        output_eval_file = os.path.join(args.output_dir, "logits_dev.txt")
-        with open(output_eval_file, "w") as f:
-            for i in range(len(logits_all)):
-                for j in range(len(logits_all[i])):
-                    f.write(str(logits_all[i][j]))
-                    if j == len(logits_all[i])-1:
-                        f.write("\n")
-                    else:
-                        f.write(" ")
+        eval_result = evaluate(model, eval_dataloader, device, precision=args.precision)
+        write_eval_results(args.output_dir, "dev", eval_result, train_state)
 
         #测试集test.json
-        eval_examples = processor.get_test_examples(args.data_dir)
-        eval_features = convert_examples_to_features(
-            eval_examples, label_list, args.max_seq_length, tokenizer)
+        eval_data = load_features(processor, "test", label_list, tokenizer, args)
 
         logger.info("***** Running evaluation *****")
-        logger.info("  Num examples = %d", len(eval_examples))
+        logger.info("  Num examples = %d", len(eval_data) * n_class)
         logger.info("  Batch size = %d", args.eval_batch_size)
 
-        input_ids = []
-        input_mask = []
-        segment_ids = []
-        label_id = []
-        
-        for f in eval_features:
-            input_ids.append([])
-            input_mask.append([])
-            segment_ids.append([])
-            for i in range(n_class):
-                input_ids[-1].append(f[i].input_ids)
-                input_mask[-1].append(f[i].input_mask)
-                segment_ids[-1].append(f[i].segment_ids)
-            label_id.append([f[0].label_id])                
-
-        all_input_ids = torch.tensor(input_ids, dtype=torch.long)
-        all_input_mask = torch.tensor(input_mask, dtype=torch.long)
-        all_segment_ids = torch.tensor(segment_ids, dtype=torch.long)
-        all_label_ids = torch.tensor(label_id, dtype=torch.long)
-
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         if args.local_rank == -1:
             eval_sampler = SequentialSampler(eval_data)
         else:
             eval_sampler = DistributedSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size,
+                                     collate_fn=feature_store.trim_collate, num_workers=args.num_workers)
 
-        model.eval()
-        eval_loss, eval_accuracy = 0, 0
-        nb_eval_steps, nb_eval_examples = 0, 0
-        logits_all = []
-        label_ids_all=[]
-        for input_ids, input_mask, segment_ids, label_ids in eval_dataloader:
-            input_ids = input_ids.to(device)
-            input_mask = input_mask.to(device)
-            segment_ids = segment_ids.to(device)
-            label_ids = label_ids.to(device)
-
-            with torch.no_grad():
-                tmp_eval_loss, logits = model(input_ids, segment_ids, input_mask, label_ids, n_class)
-
-            logits = logits.detach().cpu().numpy()
-            label_ids = label_ids.to('cpu').numpy()
-            for i in range(len(logits)):
-                logits_all += [logits[i]]
-            for i in range(len(label_ids)):
-                label_ids_all += [label_ids[i]]
-
-            tmp_eval_accuracy = accuracy(logits, label_ids.reshape(-1))
-
-            eval_loss += tmp_eval_loss.mean().item()
-            eval_accuracy += tmp_eval_accuracy
-
-            nb_eval_examples += input_ids.size(0)
-            nb_eval_steps += 1
-
-        eval_loss = eval_loss / nb_eval_steps
-        eval_accuracy = eval_accuracy / nb_eval_examples
-        # f1 = F1(label_ids_all, logits_all)
-        pre, rec, f1 = precision_recall_f1(label_ids_all, logits_all)
-        if args.do_train:
-            result = {'eval_loss': eval_loss,
-                      'eval_accuracy': eval_accuracy,
-                      'global_step': global_step,
-                      'loss': tr_loss/nb_tr_steps,
-                      'f1':f1,
-                      'pre':pre,
-                      'rec':rec}
-        else:
-            result = {'eval_loss': eval_loss,
-                      'eval_accuracy': eval_accuracy,
-                      'f1':f1,
-                      'pre':pre,
-                      'rec':rec}
-
-
-        output_eval_file = os.path.join(args.output_dir, "eval_results_test.txt")
-        with open(output_eval_file, "w") as writer:
-            logger.info("***** Eval results *****")
-            for key in sorted(result.keys()):
-                logger.info("  %s = %s", key, str(result[key]))
-                writer.write("%s = %s\n" % (key, str(result[key])))
-        output_eval_file = os.path.join(args.output_dir, "logits_test.txt")
-        with open(output_eval_file, "w") as f:
-            for i in range(len(logits_all)):
-                for j in range(len(logits_all[i])):
-                    f.write(str(logits_all[i][j]))
-                    if j == len(logits_all[i])-1:
-                        f.write("\n")
-                    else:
-                        f.write(" ")
+        eval_result = evaluate(model, eval_dataloader, device, precision=args.precision)
+        write_eval_results(args.output_dir, "test", eval_result, train_state)
 
 if __name__ == "__main__":
     main()
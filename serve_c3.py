@@ -0,0 +1,401 @@
+# coding=utf-8
+"""Long-lived C3 inference service on top of `BertForSequenceClassification`.
+
+Loads a `model_best.pt` written by `run_classifier.py` once, then scores
+(document, question, choices) requests over HTTP or JSON lines on stdio:
+
+    python serve_c3.py --checkpoint c3_curriculumLearning/model_best.pt --port 8000
+    curl -d '{"document": "...", "question": "...", "choices": ["...", "..."]}' localhost:8000/score
+
+Every response holds one logit per choice and the index of the best choice.
+Concurrent requests are grouped by `MicroBatcher` into batches of at most
+--max_batch_questions questions. A batch runs once it is full, or once its
+oldest request has waited --max_latency_ms, so a request waits at most that
+long plus the model time of one batch. The choice sequences of a batch are
+packed into rows of --max_seq_length tokens rather than padded, so a long
+document does not make every other question of its batch as long.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+import feature_store
+import modeling
+import run_classifier
+import tokenization
+from modeling import BertConfig, BertForSequenceClassification
+
+logger = logging.getLogger(__name__)
+
+
+class C3Scorer(object):
+    """Encodes C3 questions as `run_classifier.py` does and scores them with a fine-tuned model.
+
+    Given `pack_length`, the choice sequences of a batch are packed into rows
+    of at most `pack_length` tokens (see `feature_store.pack_sequences`), so
+    questions of different lengths share a batch without padding; otherwise
+    the batch is padded to its longest sequence.
+    """
+
+    def __init__(self, model, tokenizer, device, max_seq_length=512, precision="fp32", pack_length=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_seq_length = max_seq_length
+        self.precision = precision
+        self.pack_length = pack_length
+        self.label_map = {label: i for (i, label) in enumerate(run_classifier.c3Processor().get_labels())}
+        self.cls_id, self.sep_id = tokenizer.convert_tokens_to_ids(["[CLS]", "[SEP]"])
+        self._num_encoded = 0
+        self._lock = threading.Lock()
+        self.model.eval()
+
+    def encode(self, request):
+        """Validates a request and returns the (input_ids, input_mask, segment_ids, label_id) of its choices.
+
+        Texts are lower-cased and the choices padded with empty ones to
+        `run_classifier.n_class`, as `c3Processor.iter_questions` does.
+        """
+        document, question, choices = request.get("document"), request.get("question"), request.get("choices")
+        if isinstance(document, list) and all(isinstance(d, str) for d in document):
+            document = "\n".join(document)
+        if not isinstance(document, str) or not isinstance(question, str):
+            raise ValueError("document should be a string or a list of strings, and question a string")
+        if not isinstance(choices, list) or not 1 <= len(choices) <= run_classifier.n_class \
+                or not all(isinstance(c, str) for c in choices):
+            raise ValueError("choices should be a list of 1 to %d strings" % run_classifier.n_class)
+
+        document, question = document.lower(), question.lower()
+        choices = [c.lower() for c in choices] + [""] * (run_classifier.n_class - len(choices))
+        token_cache = {text: self.tokenizer.encode(text) for text in set([document, question] + choices)}
+        with self._lock:
+            # Only the first examples the service sees are logged, as in run_classifier.py.
+            ex_index = self._num_encoded
+            self._num_encoded += run_classifier.n_class
+        features = []
+        for (k, choice) in enumerate(choices):
+            example = run_classifier.InputExample(guid="serve-%d" % (ex_index + k), text_a=document,
+                                                  text_b=choice, label="0", text_c=question)
+            features.append(run_classifier._example_to_features(
+                example, ex_index + k, self.label_map, self.max_seq_length, self.tokenizer, token_cache,
+                self.cls_id, self.sep_id))
+        return (torch.tensor([f.input_ids for f in features]),
+                torch.tensor([f.input_mask for f in features]),
+                torch.tensor([f.segment_ids for f in features]),
+                torch.tensor([0]))
+
+    def score(self, encoded):
+        """Scores a batch of encoded questions; returns a [num_questions, n_class] float32 array."""
+        if self.pack_length is not None:
+            batch = feature_store.pack_collate(encoded, self.pack_length)[:5]
+            input_ids, sequence_ids, segment_ids, position_ids, cls_index = (t.to(self.device).long() for t in batch)
+            kwargs = dict(position_ids=position_ids, cls_index=cls_index)
+            input_mask = sequence_ids
+        else:
+            batch = feature_store.trim_collate(encoded)[:3]
+            input_ids, input_mask, segment_ids = (t.to(self.device).long() for t in batch)
+            kwargs = {}
+        with run_classifier.inference_mode(), modeling.autocast(self.device, self.precision):
+            logits = self.model(input_ids, segment_ids, input_mask, n_class=run_classifier.n_class, **kwargs)
+        return logits.float().cpu().numpy()
+
+
+class MicroBatcher(object):
+    """Groups items submitted from many threads into batches for `batch_fn`.
+
+    A single worker thread runs `batch_fn(items)`, which returns one result per
+    item. A batch is run as soon as it holds `max_batch_size` items, or once its
+    oldest item has waited `max_latency_ms`. `submit` returns a
+    `concurrent.futures.Future` of the item's result, or of the exception
+    `batch_fn` raised for its batch.
+    """
+
+    def __init__(self, batch_fn, max_batch_size=8, max_latency_ms=10.0):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000.0
+        self._items = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, item):
+        future = Future()
+        self._items.put((time.time(), item, future))
+        return future
+
+    def close(self):
+        """Runs the items already submitted and stops the worker thread."""
+        self._items.put(None)
+        self._thread.join()
+
+    def _next_batch(self):
+        """Waits for an item, then gathers more until the batch is full or its deadline passes."""
+        first = self._items.get()
+        if first is None:
+            return None, True
+        batch = [first]
+        deadline = first[0] + self.max_latency
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            try:
+                # Past the deadline, items that are already waiting still join the batch.
+                item = self._items.get(timeout=remaining) if remaining > 0 else self._items.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run(self):
+        closed = False
+        while not closed:
+            batch, closed = self._next_batch()
+            if not batch:
+                continue
+            futures = [future for (_, _, future) in batch]
+            try:
+                results = self.batch_fn([item for (_, item, _) in batch])
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+
+class C3Service(object):
+    """Turns request objects into response objects, batching the model calls of concurrent requests."""
+
+    def __init__(self, scorer, max_batch_questions=8, max_latency_ms=10.0):
+        self.scorer = scorer
+        self.batcher = MicroBatcher(scorer.score, max_batch_size=max_batch_questions,
+                                    max_latency_ms=max_latency_ms)
+
+    def submit(self, request):
+        """Encodes `request` in the calling thread and queues it; returns a Future of its logits.
+
+        Raises ValueError for a malformed request.
+        """
+        if not isinstance(request, dict):
+            raise ValueError("A request should be a JSON object")
+        return self.batcher.submit(self.scorer.encode(request))
+
+    @staticmethod
+    def response(request, logits):
+        logits = logits[:len(request["choices"])].tolist()
+        response = {"logits": logits, "prediction": max(range(len(logits)), key=logits.__getitem__)}
+        if "id" in request:
+            response["id"] = request["id"]
+        return response
+
+    def close(self):
+        self.batcher.close()
+
+
+class C3RequestHandler(BaseHTTPRequestHandler):
+    """POST /score scores one question; GET /health reports that the model is loaded."""
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send(404, {"error": "Unknown path %s" % self.path})
+            return
+        self._send(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/score":
+            self._send(404, {"error": "Unknown path %s" % self.path})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            future = self.server.service.submit(request)
+        except ValueError as e:
+            self._send(400, {"error": str(e)})
+            return
+        try:
+            response = self.server.service.response(request, future.result())
+        except Exception as e:
+            logger.exception("Failed to score a request")
+            self._send(500, {"error": str(e)})
+            return
+        self._send(200, response)
+
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+def serve_stdio(service, reader, writer):
+    """Scores one JSON request per line of `reader`, writing the responses to `writer` in the same order.
+
+    Lines are read ahead of the model so that they can share batches. A
+    malformed line gets an {"error": ...} response.
+    """
+    pending = queue.Queue(maxsize=service.batcher.max_batch_size * 4)
+
+    def write_responses():
+        while True:
+            entry = pending.get()
+            if entry is None:
+                break
+            request, future = entry
+            try:
+                response = service.response(request, future.result()) if future is not None else request
+            except Exception as e:
+                response = {"error": str(e)}
+            writer.write(json.dumps(response, ensure_ascii=False) + "\n")
+            writer.flush()
+
+    thread = threading.Thread(target=write_responses, name="stdio-writer")
+    thread.start()
+    for line in reader:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+            pending.put((request, service.submit(request)))
+        except ValueError as e:
+            pending.put(({"error": str(e)}, None))
+    pending.put(None)
+    thread.join()
+
+
+def load_model(args, device):
+    bert_config = BertConfig.from_json_file(args.bert_config_file)
+    if args.attention_backend is not None:
+        bert_config.attention_backend = args.attention_backend
+    if args.max_seq_length > bert_config.max_position_embeddings:
+        raise ValueError(
+            "Cannot use sequence length {} because the BERT model was only trained up to sequence length {}".format(
+            args.max_seq_length, bert_config.max_position_embeddings))
+    model = BertForSequenceClassification(bert_config, 1, shared_doc_layers=args.shared_doc_layers)
+    state_dict = torch.load(args.checkpoint, map_location='cpu')
+    state_dict = state_dict.get("model", state_dict)
+    # Checkpoints saved from DataParallel or DistributedDataParallel prefix every key with "module.".
+    state_dict = {(k[len("module."):] if k.startswith("module.") else k): v for k, v in state_dict.items()}
+    model.load_state_dict(state_dict)
+    return model.to(device=device, dtype=modeling.parameter_dtype(args.precision))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+
+    ## Required parameters
+    parser.add_argument("--checkpoint", default=None, type=str, required=True,
+                        help="The model_best.pt written by run_classifier.py.")
+    parser.add_argument("--bert_config_file",
+                        default='../chinese_L-12_H-768_A-12/bert_config.json',
+                        type=str,
+                        help="The config json file corresponding to the pre-trained BERT model. \n"
+                             "This specifies the model architecture.")
+    parser.add_argument("--vocab_file",
+                        default='../chinese_L-12_H-768_A-12/vocab.txt',
+                        type=str,
+                        help="The vocabulary file that the BERT model was trained on.")
+
+    ## Other parameters
+    parser.add_argument("--max_seq_length",
+                        default=512,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization, as in training.")
+    parser.add_argument("--do_lower_case",
+                        default=False,
+                        action='store_true',
+                        help="Whether to lower case the input text. True for uncased models, False for cased models.")
+    parser.add_argument("--shared_doc_layers",
+                        default=0,
+                        type=int,
+                        help="The --shared_doc_layers the checkpoint was trained with.")
+    parser.add_argument("--precision",
+                        default="fp32",
+                        choices=modeling.PRECISIONS,
+                        help="fp32; bf16 to run the model under bfloat16 autocast; or pure_bf16 to also "
+                             "cast the weights to bfloat16.")
+    parser.add_argument("--attention_backend",
+                        default=None,
+                        choices=modeling.ATTENTION_BACKENDS,
+                        help="Overrides the attention_backend of the BERT config: eager, or sdpa for "
+                             "PyTorch's fused scaled_dot_product_attention.")
+    parser.add_argument("--no_pack_sequences",
+                        default=False,
+                        action='store_true',
+                        help="Pad the questions of a batch to its longest sequence instead of packing their "
+                             "sequences into rows of max_seq_length tokens. Always the case with "
+                             "--shared_doc_layers.")
+    parser.add_argument("--max_batch_questions",
+                        default=8,
+                        type=int,
+                        help="Maximum number of questions scored in one forward pass.")
+    parser.add_argument("--max_latency_ms",
+                        default=10.0,
+                        type=float,
+                        help="How long the oldest request of a batch may wait for more requests to join it.")
+    parser.add_argument("--host", default="127.0.0.1", type=str)
+    parser.add_argument("--port", default=8000, type=int)
+    parser.add_argument("--stdio",
+                        default=False,
+                        action='store_true',
+                        help="Read one JSON request per line from stdin and write the responses to stdout, "
+                             "instead of serving HTTP.")
+    parser.add_argument("--no_cuda",
+                        default=False,
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                        datefmt = '%m/%d/%Y %H:%M:%S',
+                        level = logging.INFO)
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    tokenizer = tokenization.FullTokenizer(vocab_file=args.vocab_file, do_lower_case=args.do_lower_case)
+    model = load_model(args, device)
+    pack_length = None if args.no_pack_sequences or args.shared_doc_layers > 0 else args.max_seq_length
+    scorer = C3Scorer(model, tokenizer, device, max_seq_length=args.max_seq_length, precision=args.precision,
+                      pack_length=pack_length)
+    service = C3Service(scorer, max_batch_questions=args.max_batch_questions, max_latency_ms=args.max_latency_ms)
+    logger.info("Loaded %s on %s", args.checkpoint, device)
+
+    if args.stdio:
+        serve_stdio(service, sys.stdin, sys.stdout)
+        service.close()
+        return
+
+    server = ThreadingHTTPServer((args.host, args.port), C3RequestHandler)
+    server.daemon_threads = True
+    server.service = service
+    logger.info("Serving on http://%s:%d/score", args.host, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+if __name__ == "__main__":
+    main()
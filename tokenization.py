@@ -18,8 +18,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import array
 import collections
+import itertools
+import multiprocessing
 import re
+import sys
 import unicodedata
 import six
 
@@ -169,8 +173,7 @@ class FullTokenizer(object):
   def tokenize(self, text):
     split_tokens = []
     for token in self.basic_tokenizer.tokenize(text):
-      for sub_token in self.wordpiece_tokenizer.tokenize(token):
-        split_tokens.append(sub_token)
+      split_tokens.extend(self.wordpiece_tokenizer.tokenize_word(token))
 
     return split_tokens
 
@@ -180,6 +183,90 @@ class FullTokenizer(object):
   def convert_ids_to_tokens(self, ids):
     return convert_by_vocab(self.inv_vocab, ids)
 
+  def encode(self, text):
+    """Tokenizes `text` into an `array.array("i")` of vocab ids."""
+    return array.array("i", self.convert_tokens_to_ids(self.tokenize(text)))
+
+  def tokenize_batch(self, texts, num_workers=None, chunksize=256, pool=None):
+    """Tokenizes every text in `texts`, in order. See `encode_batch`."""
+    tokens = []
+    for ids in self.encode_batch(texts, num_workers, chunksize, pool):
+      tokens.append(self.convert_ids_to_tokens(ids))
+    return tokens
+
+  def worker_pool(self, num_workers=None):
+    """Starts `num_workers` processes (default: the number of CPUs) that hold this tokenizer.
+
+    Pass the pool to `encode_batch` to reuse it across calls, and close it
+    when done; it can be used as a context manager.
+    """
+    if num_workers is None:
+      num_workers = multiprocessing.cpu_count()
+    # Each worker receives the tokenizer once, when it starts (for free when
+    # the pool forks), instead of with every chunk of texts.
+    return multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(self,))
+
+  def encode_batch(self, texts, num_workers=None, chunksize=256, pool=None):
+    """Encodes every text in `texts`, in order, into an `array.array("i")` of ids.
+
+    Args:
+      texts: a sequence of strings.
+      num_workers: number of worker processes the texts are sharded across.
+        Defaults to the number of CPUs; 1 encodes in this process.
+      chunksize: number of texts sent to a worker at a time.
+      pool: a pool from `worker_pool` to encode with. `num_workers` is then
+        ignored; otherwise a pool is started and closed for this call only.
+
+    Returns:
+      A list with the ids of each text.
+    """
+    chunks = [texts[i:i + chunksize] for i in range(0, len(texts), chunksize)]
+    if pool is not None:
+      return _encode_chunks(pool, chunks)
+    if num_workers is None:
+      num_workers = multiprocessing.cpu_count()
+    num_workers = min(num_workers, len(chunks))
+    if num_workers <= 1:
+      return [self.encode(text) for text in texts]
+
+    pool = self.worker_pool(num_workers)
+    try:
+      return _encode_chunks(pool, chunks)
+    finally:
+      pool.close()
+      pool.join()
+
+
+def _encode_chunks(pool, chunks):
+  """Encodes `chunks` of texts on `pool`; each chunk comes back as two flat int arrays."""
+  output = []
+  for (ids, lengths) in pool.imap(_encode_chunk, chunks):
+    start = 0
+    for length in lengths:
+      output.append(ids[start:start + length])
+      start += length
+  return output
+
+
+# The tokenizer of a `FullTokenizer.encode_batch` worker process.
+_worker_tokenizer = None
+
+
+def _init_worker(tokenizer):
+  global _worker_tokenizer
+  _worker_tokenizer = tokenizer
+
+
+def _encode_chunk(texts):
+  """Encodes `texts` in a worker into their concatenated ids and their lengths."""
+  ids = array.array("i")
+  lengths = array.array("i")
+  for text in texts:
+    text_ids = _worker_tokenizer.encode(text)
+    ids.extend(text_ids)
+    lengths.append(len(text_ids))
+  return ids, lengths
+
 
 class BasicTokenizer(object):
   """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
@@ -202,62 +289,28 @@ class BasicTokenizer(object):
     # and generally don't have any Chinese data in them (there are Chinese
     # characters in the vocabulary because Wikipedia does have some Chinese
     # words in the English Wikipedia.).
-    text = self._tokenize_chinese_chars(text)
-
-    orig_tokens = whitespace_tokenize(text)
-    split_tokens = []
-    for token in orig_tokens:
-      if self.do_lower_case:
-        token = token.lower()
-        token = self._run_strip_accents(token)
-      split_tokens.extend(self._run_split_on_punc(token))
-
-    output_tokens = whitespace_tokenize(" ".join(split_tokens))
-    return output_tokens
+    #
+    # Every CJK character becomes a token of its own, just like punctuation,
+    # so both are split off in the single `_TOKEN_RE` pass at the end. Lower
+    # casing and accent stripping never turn a CJK character into anything
+    # else or anything else into one, and never move characters across
+    # whitespace, so they run over the whole text at once.
+    if self.do_lower_case:
+      text = self._run_strip_accents(text.lower())
+    return _TOKEN_RE.findall(text)
 
   def _run_strip_accents(self, text):
     """Strips accents from a piece of text."""
     text = unicodedata.normalize("NFD", text)
-    output = []
-    for char in text:
-      cat = unicodedata.category(char)
-      if cat == "Mn":
-        continue
-      output.append(char)
-    return "".join(output)
+    return _NONSPACING_MARK_RE.sub("", text)
 
   def _run_split_on_punc(self, text):
     """Splits punctuation on a piece of text."""
-    chars = list(text)
-    i = 0
-    start_new_word = True
-    output = []
-    while i < len(chars):
-      char = chars[i]
-      if _is_punctuation(char):
-        output.append([char])
-        start_new_word = True
-      else:
-        if start_new_word:
-          output.append([])
-        start_new_word = False
-        output[-1].append(char)
-      i += 1
-
-    return ["".join(x) for x in output]
+    return _PUNCTUATION_RE.sub(r" \g<0> ", text).split()
 
   def _tokenize_chinese_chars(self, text):
     """Adds whitespace around any CJK character."""
-    output = []
-    for char in text:
-      cp = ord(char)
-      if self._is_chinese_char(cp):
-        output.append(" ")
-        output.append(char)
-        output.append(" ")
-      else:
-        output.append(char)
-    return "".join(output)
+    return _CHINESE_CHAR_RE.sub(r" \g<0> ", text)
 
   def _is_chinese_char(self, cp):
     """Checks whether CP is the codepoint of a CJK character."""
@@ -269,30 +322,16 @@ class BasicTokenizer(object):
     # as is Japanese Hiragana and Katakana. Those alphabets are used to write
     # space-separated words, so they are not treated specially and handled
     # like the all of the other languages.
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-      return True
+    for (first, last) in _CHINESE_CHAR_RANGES:
+      if cp >= first and cp <= last:
+        return True
 
     return False
 
   def _clean_text(self, text):
     """Performs invalid character removal and whitespace cleanup on text."""
-    output = []
-    for char in text:
-      cp = ord(char)
-      if cp == 0 or cp == 0xfffd or _is_control(char):
-        continue
-      if _is_whitespace(char):
-        output.append(" ")
-      else:
-        output.append(char)
-    return "".join(output)
+    text = _WHITESPACE_RE.sub(" ", text)
+    return _INVALID_CHAR_RE.sub("", text)
 
 
 class WordpieceTokenizer(object):
@@ -302,6 +341,7 @@ class WordpieceTokenizer(object):
     self.vocab = vocab
     self.unk_token = unk_token
     self.max_input_chars_per_word = max_input_chars_per_word
+    self.word_trie, self.suffix_trie = _build_wordpiece_tries(vocab)
 
   def tokenize(self, text):
     """Tokenizes a piece of text into its word pieces.
@@ -321,37 +361,68 @@ class WordpieceTokenizer(object):
 
     output_tokens = []
     for token in whitespace_tokenize(text):
-      chars = list(token)
-      if len(chars) > self.max_input_chars_per_word:
-        output_tokens.append(self.unk_token)
-        continue
-
-      is_bad = False
-      start = 0
-      sub_tokens = []
-      while start < len(chars):
-        end = len(chars)
-        cur_substr = None
-        while start < end:
-          substr = "".join(chars[start:end])
-          if start > 0:
-            substr = "##" + substr
-          if substr in self.vocab:
-            cur_substr = substr
-            break
-          end -= 1
-        if cur_substr is None:
-          is_bad = True
-          break
-        sub_tokens.append(cur_substr)
-        start = end
-
-      if is_bad:
-        output_tokens.append(self.unk_token)
-      else:
-        output_tokens.extend(sub_tokens)
+      output_tokens.extend(self.tokenize_word(token))
     return output_tokens
 
+  def tokenize_word(self, word):
+    """Tokenizes a single word, without whitespace, into its word pieces."""
+    if len(word) > self.max_input_chars_per_word:
+      return [self.unk_token]
+    # A word in the vocab is its own longest match.
+    if word in self.vocab:
+      return [word]
+
+    sub_tokens = []
+    trie = self.word_trie
+    start = 0
+    while start < len(word):
+      # Walk the trie along the word, remembering the longest piece passed.
+      node = trie
+      cur_substr = None
+      for i in range(start, len(word)):
+        node = node.get(word[i])
+        if node is None:
+          break
+        if _TRIE_TOKEN in node:
+          cur_substr = node[_TRIE_TOKEN]
+          end = i + 1
+      if cur_substr is None:
+        return [self.unk_token]
+      sub_tokens.append(cur_substr)
+      start = end
+      trie = self.suffix_trie
+    return sub_tokens
+
+
+# Key of the vocab token ending at a trie node. It can not clash with the
+# single-character keys of the children.
+_TRIE_TOKEN = ""
+
+
+def _build_wordpiece_tries(vocab):
+  """Builds character tries over the word-initial and "##" continuation pieces.
+
+  Each node is a dict from a character to the next node; a node at which a
+  vocab token ends holds that token under `_TRIE_TOKEN`. Any token can start a
+  word, while a continuation can only be a "##" token without its "##".
+  """
+  word_trie = {}
+  suffix_trie = {}
+
+  def insert(trie, chars, token):
+    if not chars:
+      return
+    node = trie
+    for char in chars:
+      node = node.setdefault(char, {})
+    node[_TRIE_TOKEN] = token
+
+  for token in vocab:
+    insert(word_trie, token, token)
+    if token.startswith("##"):
+      insert(suffix_trie, token[2:], token)
+  return word_trie, suffix_trie
+
 
 def _is_whitespace(char):
   """Checks whether `chars` is a whitespace character."""
@@ -391,3 +462,88 @@ def _is_punctuation(char):
   if cat.startswith("P"):
     return True
   return False
+
+
+# The CJK Unified Ideographs blocks, see `BasicTokenizer._is_chinese_char`.
+_CHINESE_CHAR_RANGES = [
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+]
+
+
+def _char_class_pattern(ranges):
+  """Builds a regex matching any single character in the codepoint `ranges`."""
+
+  def char_class(ranges):
+    return "[%s]" % "".join("\\U%08x-\\U%08x" % (first, last) for (first, last) in ranges)
+
+  # `re` matches a class of Basic Multilingual Plane characters against a
+  # bitmap, but scans the ranges of a class one by one once it reaches past
+  # U+FFFF. The supplementary planes are kept in a separate class behind a
+  # cheap lookahead, so only their (rare) characters pay for the scan.
+  bmp = [(first, min(last, 0xFFFF)) for (first, last) in ranges if first <= 0xFFFF]
+  astral = [(max(first, 0x10000), last) for (first, last) in ranges if last > 0xFFFF]
+  patterns = []
+  if bmp:
+    patterns.append(char_class(bmp))
+  if astral:
+    patterns.append("(?=[\\U00010000-\\U%08x])%s" % (sys.maxunicode, char_class(astral)))
+  return "(?:%s)" % "|".join(patterns)
+
+
+def _category_runs():
+  """Yields (category, first, last) for every run of codepoints sharing a Unicode category."""
+  categories = map(unicodedata.category, map(six.unichr, range(sys.maxunicode + 1)))
+  first = 0
+  for (cat, run) in itertools.groupby(categories):
+    last = first + len(list(run)) - 1
+    yield (cat, first, last)
+    first = last + 1
+
+
+def _build_codepoint_classes():
+  """Classifies every codepoint once, with the rules of `_is_whitespace`,
+  `_is_control` and `_is_punctuation`.
+
+  Returns:
+    A dict of (first, last) codepoint ranges for the whitespace, invalid,
+    punctuation and nonspacing mark ("Mn") characters. Whitespace has to be
+    replaced before invalid characters are removed, since tabs and
+    newlines are control characters that count as whitespace.
+  """
+  classes = {
+      "whitespace": [(0x9, 0x9), (0xA, 0xA), (0xD, 0xD), (0x20, 0x20)],
+      "invalid": [(0x0, 0x0), (0xFFFD, 0xFFFD)],
+      # We treat all non-letter/number ASCII as punctuation, as in
+      # `_is_punctuation`.
+      "punctuation": [(33, 47), (58, 64), (91, 96), (123, 126)],
+      "nonspacing_mark": [],
+  }
+  for (cat, first, last) in _category_runs():
+    if cat == "Zs":
+      classes["whitespace"].append((first, last))
+    elif cat.startswith("C"):
+      classes["invalid"].append((first, last))
+    elif cat.startswith("P"):
+      classes["punctuation"].append((first, last))
+    elif cat == "Mn":
+      classes["nonspacing_mark"].append((first, last))
+  return classes
+
+
+_CODEPOINT_CLASSES = _build_codepoint_classes()
+_INVALID_CHAR_RE = re.compile(_char_class_pattern(_CODEPOINT_CLASSES["invalid"]))
+_WHITESPACE_RE = re.compile(_char_class_pattern(_CODEPOINT_CLASSES["whitespace"]))
+_PUNCTUATION_RE = re.compile(_char_class_pattern(_CODEPOINT_CLASSES["punctuation"]))
+_NONSPACING_MARK_RE = re.compile(_char_class_pattern(_CODEPOINT_CLASSES["nonspacing_mark"]))
+_CHINESE_CHAR_RE = re.compile(_char_class_pattern(_CHINESE_CHAR_RANGES))
+# A basic token: one CJK or punctuation character, or a run of any other
+# non-whitespace characters. `\S` agrees with `str.split` on what whitespace is.
+_SPLIT_CHAR = _char_class_pattern(_CHINESE_CHAR_RANGES + _CODEPOINT_CLASSES["punctuation"])
+_TOKEN_RE = re.compile(r"%s|(?:(?!%s)\S)+" % (_SPLIT_CHAR, _SPLIT_CHAR))